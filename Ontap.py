@@ -1,9 +1,31 @@
+from array import array
+import base64
+import bisect
+import collections
+from errno import ECONNABORTED, ECONNRESET, EPIPE
+import httplib
+import json
+import mmap
+import os
+import Queue
 import re
+import select
+import socket
+import sqlite3
+import ssl
+import struct
 import sys
+import threading
+import time
+import xml.parsers.expat
+import zlib
+from xml.sax.saxutils import escape
 
 from NaElement import NaElement
 from NaServer import NaServer
 
+NAN = float('nan')
+
 class OntapApiException(Exception):
     """Expose errors surfaced in the NetApp API as exceptions."""
 
@@ -22,19 +44,137 @@ class OntapException(Exception):
 class Filer:
     """A NetApp filer."""
 
-    def __init__(self, hostname, user, passwd):
-        self.api = NaServer(hostname, 1, 3)
-        self.api.set_style('LOGIN')
-        self.api.set_admin_user(user, passwd)
-        self.api.set_transport_type('HTTPS')
+    def __init__(self, hostname, user, passwd, perf_batch_size=100,
+                 metadata_cache=None, inventory_ttl=60, response_cache=None,
+                 keepalive=False, pool_size=4, idle_timeout=60,
+                 transport=None, version=None, fast_xml=False, record=None,
+                 replay=None, max_in_flight=None):
+        """
+        Connect to filer 'hostname' as 'user'.
+
+        perf_batch_size - number of perf instances fetched per API call
+        metadata_cache - optional MetadataCache, or path to one, used to
+                         persist perf counter descriptions between runs
+        inventory_ttl - seconds for which filer-wide listings (such as the
+                        volume inventory) are reused; 0 disables reuse
+        response_cache - optional ResponseCache through which read-only
+                         API calls are answered
+        keepalive - if True, send API calls over persistent HTTPS
+                    connections (a KeepAliveTransport) instead of NaServer
+        pool_size - number of idle persistent connections kept open
+        idle_timeout - seconds after which an idle connection is closed
+        transport - optional object providing NaServer's invoke and
+                    invoke_elem, used instead of connecting to hostname
+        version - the filer's ONTAP version, if already known
+        fast_xml - if True, decode responses into lightweight ZapiElements
+                   instead of NaElements (implies keepalive)
+        record - optional path of a log to which every request and
+                 response is appended (implies keepalive); see
+                 RecordingTransport
+        replay - optional path of a log written with 'record', from which
+                 responses are served instead of connecting to hostname
+        max_in_flight - if given, calls beyond an adaptive limit of at
+                        most this many in flight wait for others to
+                        complete; see AdaptiveLimiter
+
+        No API call is made until one is needed: the version is looked up
+        (in metadata_cache, else with system-get-version) on first use.
+        """
+
+        if transport:
+            self.api = transport
+        elif replay:
+            self.api = ReplayTransport(replay, fast_xml=fast_xml)
+        elif record:
+            self.api = RecordingTransport(hostname, user, passwd, record,
+                                          pool_size=pool_size,
+                                          idle_timeout=idle_timeout,
+                                          fast_xml=fast_xml)
+        elif keepalive or fast_xml:
+            self.api = KeepAliveTransport(hostname, user, passwd,
+                                          pool_size=pool_size,
+                                          idle_timeout=idle_timeout,
+                                          fast_xml=fast_xml)
+        else:
+            self.api = NaServer(hostname, 1, 3)
+            self.api.set_style('LOGIN')
+            self.api.set_admin_user(user, passwd)
+            self.api.set_transport_type('HTTPS')
 
         self.name = hostname
-        out = self.invoke('system-get-version')
-        self.version = out.child_get_string('version')
+        self.response_cache = response_cache
+        self.invoke_hooks = []
+        self.limiter = None
+        if max_in_flight:
+            self.limiter = AdaptiveLimiter(max_limit=max_in_flight)
+        if version:
+            self.version = version
 
         # Used for caching performance object descriptions:
         self.perf_obj_info = {}
 
+        # Number of perf object instances fetched per iter-next call:
+        self.perf_batch_size = perf_batch_size
+
+        if isinstance(metadata_cache, basestring):
+            metadata_cache = MetadataCache(metadata_cache)
+        self.metadata_cache = metadata_cache
+
+        # Used for caching filer-wide listings:
+        self.inventory_ttl = inventory_ttl
+        self._aggr_space = None
+        self._aggr_space_time = 0
+        self._volumes = InventoryTable(self._fresh)
+        self._exports = InventoryTable(self._fresh)
+        self._shares = InventoryTable(self._fresh)
+        self._snapshots = {}
+
+    def add_invoke_hook(self, hook):
+        """
+        Call hook(event) after every API call made through this Filer.
+
+        event is a dict with the following keys:
+
+        filer - Filer's hostname
+        api - Name of the API called ('system-cli' for invoke_cli)
+        seconds - Time taken by the call
+        request-bytes - Size of the request as XML
+        response-bytes - Size of the response as XML (0 if none)
+        errno - ZAPI error number as a string, or None on success
+
+        Responses answered by the response cache are not reported.  See
+        InvokeMetrics for a hook that aggregates these events.
+        """
+
+        self.invoke_hooks.append(hook)
+
+    def __getattr__(self, name):
+        """Look up the filer's ONTAP version on first use of self.version."""
+
+        if name != 'version':
+            raise AttributeError(name)
+
+        version = None
+        if self.metadata_cache:
+            version = self.metadata_cache.get_version(self.name)
+        if version is None:
+            out = self.invoke('system-get-version')
+            version = out.child_get_string('version')
+            if self.metadata_cache:
+                self.metadata_cache.set_version(self.name, version)
+
+        self.version = version
+        return version
+
+    def close(self):
+        """
+        Close the transport's idle connections and, when recording, its
+        log.  The Filer should not be used afterwards.
+        """
+
+        if hasattr(self.api, 'close'):
+            self.api.close()
+
     def create_volume(self, name, aggr, size):
         v = FlexVol(self, name)
         v.create(aggr, size)
@@ -60,6 +200,59 @@ class Filer:
         else:
             return False
 
+    def get_aggr_space_table(self, refresh=False):
+        """
+        Return an AggrSpaceTable of every aggregate on the filer.
+
+        The table is loaded with a single aggr-list-info call and reused
+        for self.inventory_ttl seconds, unless refresh is True.
+        """
+
+        if (refresh or self._aggr_space is None or
+            not self._fresh(self._aggr_space_time)):
+            now = time.time()
+            out = self.invoke('aggr-list-info')
+            names = []
+            rows = []
+            for aggr in out.child_get('aggregates').children_get():
+                names.append(aggr.child_get_string('name'))
+                rows.append(self._parse_aggr_space(aggr))
+            self._aggr_space = AggrSpaceTable([self.name] * len(names),
+                                              names, rows)
+            self._aggr_space_time = now
+
+        return self._aggr_space
+
+    def get_aggrs(self):
+        """Return a list of Aggr objects that exist on filer."""
+
+        return [Aggr(self, name)
+                for name in sorted(self.get_aggr_space_table().names)]
+
+    def get_autosize(self, volumes=None, max_workers=8):
+        """
+        Return a dict of FlexVol.get_autosize results keyed by volume name.
+
+        volumes - optional list of volume names (default: all volumes)
+        max_workers - number of volume-autosize-get calls run at once
+
+        If any call fails, the first OntapApiException is raised once all
+        calls have finished.
+        """
+
+        if volumes is None:
+            volumes = sorted(self.get_volume_inventory())
+
+        vols = [FlexVol(self, name) for name in volumes]
+        results = _parallel_map(lambda v: v.get_autosize(), vols, max_workers)
+
+        autosizes = {}
+        for v, (result, error) in zip(vols, results):
+            if error:
+                raise error
+            autosizes[v.name] = result
+        return autosizes
+
     def get_cifs_homedirs(self):
         """
         Equivalent to 'cifs homedir' on the CLI.
@@ -89,18 +282,46 @@ class Filer:
         else:
             return False
 
+    def get_export_table(self, refresh=False):
+        """
+        Return a dict of every NFS export rule, keyed by pathname.
+
+        The table is loaded with a single nfs-exportfs-list-rules call and
+        reused for self.inventory_ttl seconds, unless refresh is True.
+        Each value is a dict with the following keys:
+
+        pathname - Path of the export
+        nosuid - boolean
+        read-only - List of hosts permitted read-only access
+        read-write - List of hosts permitted read/write access
+        root - List of hosts permitted root access
+        sec-flavor - Security flavor of the export, or None
+        """
+
+        exports = None
+        if not refresh:
+            exports = self._exports.values()
+
+        if exports is None:
+            now = time.time()
+            out = self.invoke('nfs-exportfs-list-rules')
+            exports = {}
+            for export in out.child_get('rules').children_get():
+                rule = self._parse_export_rule(export)
+                exports[rule['pathname']] = rule
+            self._exports.load(now, exports)
+
+        return exports
+
     def get_exports(self):
         """Return a list of Export objects of filer's configured NFS shares."""
 
-        out = self.invoke('nfs-exportfs-list-rules')
-
         exports = []
 
-        for export in out.child_get('rules').children_get():
-            path = export.child_get_string('pathname')
+        for path in sorted(self.get_export_table()):
             exports.append(Export(self, path))
 
-        return exports                         
+        return exports
 
     def get_fs_status_msg(self):
         """Return a string containing the file system status message."""
@@ -113,7 +334,8 @@ class Filer:
         out = self.invoke('snmp-get', 'object-id', oid)
         return out.child_get_string('value')
 
-    def get_perf_object(self, objectname, read=[], instances=[]):
+    def get_perf_object(self, objectname, read=[], instances=[],
+                        batch_size=None):
         """
         Return objectname's performance data in a dict tree.
 
@@ -121,61 +343,15 @@ class Filer:
                If not set, all counters are reported.
         instances - optional array of instances whose values are to be read.
                     If not set, all instances are reported.
+        batch_size - optional number of instances fetched per API call.
+                     If not set, self.perf_batch_size is used.
         """
 
-        info = self.get_perf_object_info(objectname)
-
-        get_perf_obj = NaElement('perf-object-get-instances-iter-start')
-        get_perf_obj.child_add(NaElement('objectname', objectname))
-
-        if read:
-            read_counters = NaElement('counters')
-            for c in read:
-                read_counters.child_add(NaElement('counter', c))
-            get_perf_obj.child_add(read_counters)
-
-        if instances:
-            insts = NaElement('instances')
-            for inst in instances:
-                insts.child_add(NaElement('instance', inst))
-            get_perf_obj.child_add(insts)
-
-        out = self.invoke_elem(get_perf_obj)
-
-        iter_tag = out.child_get_int('tag')
-        iter_recs = out.child_get_int('records')
-
         perf_insts = {}
-        i = 0
-        while i < iter_recs:
-            out = self.invoke('perf-object-get-instances-iter-next',
-                              'maximum', 1,
-                              'tag', iter_tag)
-            inst = out.child_get('instances').child_get('instance-data')
-            inst_name = inst.child_get_string('name')
-            perf_insts[inst_name] = {}
-            counters = inst.child_get('counters').children_get()
-            for c in counters:
-                name = c.child_get_string('name')
-                if info[name]['type'] == 'array':
-                    vals = c.child_get_string('value').split(',')
-                    data = {}
-                    j = 0
-                    while j < len(vals):
-                        data[info[name]['labels'][j]] = int(vals[j])
-                        j = j + 1
-                    perf_insts[inst_name][name] = data
-                else:
-                    try:
-                        perf_insts[inst_name][name] = c.child_get_int('value')
-                    except ValueError:
-                        # Must be a string...
-                        perf_insts[inst_name][name] = c.child_get_string(
-                            'value')
-                
-            i = i + 1
-
-        self.invoke('perf-object-get-instances-iter-end', 'tag', iter_tag)
+        for inst_name, counters in self.iter_perf_object(objectname, read,
+                                                         instances,
+                                                         batch_size):
+            perf_insts[inst_name] = counters
         return perf_insts
 
     def get_perf_object_info(self, objectname):
@@ -188,7 +364,14 @@ class Filer:
         # Check cache:
         if self.perf_obj_info.has_key(objectname):
             return self.perf_obj_info[objectname]
-        
+
+        if self.metadata_cache:
+            counters = self.metadata_cache.get_perf_object_info(
+                self.name, self.version, objectname)
+            if counters is not None:
+                self.perf_obj_info[objectname] = counters
+                return counters
+
         out = self.invoke('perf-object-counter-list-info',
                           'objectname', objectname)
         counters = {}
@@ -214,6 +397,9 @@ class Filer:
 
         # Store info in cache and return
         self.perf_obj_info[objectname] = counters
+        if self.metadata_cache:
+            self.metadata_cache.set_perf_object_info(self.name, self.version,
+                                                     objectname, counters)
         return counters
 
     def get_perf_object_list(self):
@@ -244,30 +430,75 @@ class Filer:
         else:
             return False   
     
-    def get_shares(self):
-        """Return a list of Share objects containing filer's CIFS exports."""
+    def get_share_table(self, refresh=False):
+        """
+        Return a dict of every CIFS share's configuration, keyed by name.
+
+        The table is parsed from a single 'cifs shares' CLI call and
+        reused for self.inventory_ttl seconds, unless refresh is True.
+        Each value is a dict with the following keys:
+
+        name - Name of the share
+        mount-point - Path the share exports
+        description - Share comment, or False if not set
+        dir_umask, file_umask, forcegroup, umask - Option value, or False
+        options - List of other options set on the share
+        access - Dict of ACL entries, mapping user or group to rights
+        """
 
-        out = self.invoke_cli('cifs', 'shares')
+        shares = None
+        if not refresh:
+            shares = self._shares.values()
 
-        # Pattern of output is two header lines, followed by each share name
-        # starting at the left-hand side of the output.  Regexp accounts
-        # For share name being able to include whitespace and other
-        # characters - match is anchored on first "/" following whitespace,
-        # which is presumed to be the start of the mount point.
+        if shares is None:
+            now = time.time()
+            out = self.invoke_cli('cifs', 'shares')
+            shares = self._parse_cifs_shares(
+                out.child_get('cli-output').element['content'])
+            self._shares.load(now, shares)
 
-        output = out.child_get('cli-output').element['content'].splitlines()
+        return shares
 
-        share_pattern = re.compile(r'^([a-zA-Z].*\S)\s+\/')
+    def get_shares(self):
+        """Return a list of Share objects containing filer's CIFS exports."""
 
         shares = []
-        
-        for line in output[2:]:
-            m = share_pattern.match(line)
-            if m:
-                shares.append(Share(self, m.groups()[0]))
+
+        for name in sorted(self.get_share_table()):
+            shares.append(Share(self, name))
 
         return shares
 
+    def get_snapshot_catalogs(self, volumes=None, refresh=False,
+                              max_workers=8):
+        """
+        Return a dict of SnapshotCatalogs keyed by volume name.
+
+        volumes - optional list of volume names (default: all volumes)
+        refresh - if True, reload every catalog, even if fresh
+        max_workers - number of snapshot-list-info calls run at once
+
+        Catalogs are reused for self.inventory_ttl seconds, and kept up
+        to date by FlexVol's snapshot_create, snapshot_delete and
+        snapshot_rename; only missing or stale catalogs are loaded.  If
+        any call fails, the first OntapApiException is raised once all
+        calls have finished.
+        """
+
+        if volumes is None:
+            volumes = sorted(self.get_volume_inventory())
+
+        results = _parallel_map(
+            lambda name: self._get_snapshot_catalog(name, refresh),
+            volumes, max_workers)
+
+        catalogs = {}
+        for name, (result, error) in zip(volumes, results):
+            if error:
+                raise error
+            catalogs[name] = result
+        return catalogs
+
     def get_option(self, name):
         """Equivalent to 'options <name>' on the CLI."""
 
@@ -282,14 +513,37 @@ class Filer:
         else:
             return False
 
+    def get_volume_inventory(self, refresh=False):
+        """
+        Return a dict of every volume's volume-info, keyed by volume name.
+
+        The inventory is loaded with a single volume-list-info call and
+        reused for self.inventory_ttl seconds, unless refresh is True.
+        Each value is a dict of the volume-info fields, with sizes and
+        counts as integers.
+        """
+
+        volumes = None
+        if not refresh:
+            volumes = self._volumes.values()
+
+        if volumes is None:
+            now = time.time()
+            out = self.invoke('volume-list-info')
+            volumes = {}
+            for volume in out.child_get('volumes').children_get():
+                info = self._parse_volume_info(volume)
+                volumes[info['name']] = info
+            self._volumes.load(now, volumes)
+
+        return volumes
+
     def get_volumes(self):
         """Retun a list of FlexVol objects that exist on filer."""
 
         volumes = []
 
-        out = self.invoke('volume-list-info')
-        for volume in out.child_get('volumes').children_get():
-            name = volume.child_get_string('name')
+        for name in sorted(self.get_volume_inventory()):
             volumes.append(FlexVol(self, name))
 
         return volumes
@@ -297,20 +551,33 @@ class Filer:
     def has_export(self, path):
         """Check if filer has NFS export name; return boolean."""
 
+        listed = self._exports.contains(path)
+        if listed is not None:
+            return listed
+
         export = Export(self, path)
         return export.configured()
 
     def has_share(self, name):
         """Check if filer has CIFS share name; return boolean."""
 
+        listed = self._shares.contains(name)
+        if listed is not None:
+            return listed
+
         share = Share(self, name)
         return share.configured()
 
     def has_volume(self, name):
         """Check if filer has FlexVol name; return boolean."""
-        
+
+        name = FlexVol(self, name).name
+        listed = self._volumes.contains(name)
+        if listed is not None:
+            return listed
+
         try:
-            self.invoke('volume-list-info', 'volume', name)
+            self._get_volume_info(name)
         except OntapApiException as e:
             if e.errno == '13040':
                 return False
@@ -319,10 +586,9 @@ class Filer:
         return True
 
     def invoke(self, *args):
-        out = self.api.invoke(*args)
-        if out.results_status() == 'failed':
-            raise OntapApiException(out.results_errno(), out.results_reason())
-        return out
+        """Call the NetApp API with an API name and name/value pairs."""
+
+        return self._invoke(args[0], args[1:], self.api.invoke, *args)
 
     def invoke_cli(self, *cli_args):
         """
@@ -338,18 +604,86 @@ class Filer:
 
         cli = NaElement('system-cli')
         cli.child_add(args)
-        out = self.api.invoke_elem(cli)
-        if out.results_status() == 'failed':
-            raise OntapApiException(out.results_errno(), out.results_reason())
-        return out
+        return self._invoke('system-cli', cli_args, self.api.invoke_elem, cli)
 
     def invoke_elem(self, naelement):
         """Call the NetApp API using an NaElement."""
 
-        out = self.api.invoke_elem(naelement)
-        if out.results_status() == 'failed':
-            raise OntapApiException(out.results_errno(), out.results_reason())
-        return out
+        return self._invoke(naelement.element['name'],
+                            self._elem_to_args(naelement),
+                            self.api.invoke_elem, naelement)
+
+    def invoke_many(self, requests, max_in_flight=4):
+        """
+        Make several independent API calls concurrently.
+
+        requests - list of calls, each either a tuple of invoke()
+                   arguments, e.g. ('snapshot-get-reserve', 'volume', 'vol0'),
+                   or an NaElement for invoke_elem()
+        max_in_flight - maximum number of calls in progress at once
+
+        Return a list of CallResults in the order of requests.
+        """
+
+        def call(request):
+            if isinstance(request, tuple):
+                return self.invoke(*request)
+            return self.invoke_elem(request)
+
+        return [CallResult(result, error) for result, error in
+                _parallel_map(call, requests, max_in_flight)]
+
+    def iter_perf_object(self, objectname, read=[], instances=[],
+                         batch_size=None):
+        """
+        Generate (instance name, counter dict) tuples for objectname.
+
+        Instances are fetched from the filer batch_size at a time
+        (default self.perf_batch_size), so only one page of instance
+        data is held in memory at once.  Arguments are otherwise the
+        same as for get_perf_object.
+        """
+
+        if not batch_size:
+            batch_size = self.perf_batch_size
+
+        info = self.get_perf_object_info(objectname)
+
+        get_perf_obj = NaElement('perf-object-get-instances-iter-start')
+        get_perf_obj.child_add(NaElement('objectname', objectname))
+
+        if read:
+            read_counters = NaElement('counters')
+            for c in read:
+                read_counters.child_add(NaElement('counter', c))
+            get_perf_obj.child_add(read_counters)
+
+        if instances:
+            insts = NaElement('instances')
+            for inst in instances:
+                insts.child_add(NaElement('instance', inst))
+            get_perf_obj.child_add(insts)
+
+        out = self.invoke_elem(get_perf_obj)
+
+        iter_tag = out.child_get_int('tag')
+        iter_recs = out.child_get_int('records')
+
+        try:
+            i = 0
+            while i < iter_recs:
+                out = self.invoke('perf-object-get-instances-iter-next',
+                                  'maximum', batch_size,
+                                  'tag', iter_tag)
+                if out.child_get_int('records') == 0:
+                    break
+                for inst in out.child_get('instances').children_get():
+                    yield (inst.child_get_string('name'),
+                           self._parse_perf_counters(info, inst))
+                    i = i + 1
+        finally:
+            self.invoke('perf-object-get-instances-iter-end',
+                        'tag', iter_tag)
 
     def set_cifs_homedirs(self, homedirs):
         """Set the list of CIFS home directory paths for the filer."""
@@ -368,6 +702,363 @@ class Filer:
 
         self.invoke('options-set', 'name', option, 'value', value)
 
+    def _cached_snapshot_catalog(self, volume):
+        """Return volume's loaded SnapshotCatalog, fresh or not, or None."""
+
+        if volume in self._snapshots:
+            return self._snapshots[volume][1]
+        return None
+
+    def _elem_to_args(self, nae):
+        """Flatten an NaElement's leaves into a tuple of name/value pairs."""
+
+        args = ()
+        for child in nae.children_get():
+            if child.has_children():
+                args = args + self._elem_to_args(child)
+            else:
+                args = args + (child.element['name'], child.element['content'])
+        return args
+
+    def _forget_export(self, path, listing=False):
+        """
+        Drop cached rule for NFS export path.
+
+        If listing is True, the set of export paths is also discarded,
+        e.g. because an export was created or deleted.
+        """
+
+        self._exports.forget(path, listing)
+
+    def _forget_share(self, name, listing=False):
+        """
+        Drop cached configuration for CIFS share name.
+
+        If listing is True, the set of share names is also discarded,
+        e.g. because a share was created or deleted.
+        """
+
+        self._shares.forget(name, listing)
+
+    def _forget_snapshots(self, volume):
+        """Drop the cached SnapshotCatalog of volume."""
+
+        self._snapshots.pop(volume, None)
+
+    def _forget_volume(self, name, listing=False):
+        """
+        Drop cached volume-info for volume name.
+
+        If listing is True, the set of volume names is also discarded,
+        e.g. because a volume was created or destroyed.
+        """
+
+        self._volumes.forget(name, listing)
+
+    def _fresh(self, timestamp):
+        """Return True if data loaded at timestamp is within inventory_ttl."""
+
+        return time.time() - timestamp < self.inventory_ttl
+
+    def _get_aggr_space(self, name):
+        """
+        Return the fs-space-info dict for aggregate name.
+
+        Aggregate space table data is used if fresh; otherwise just this
+        aggregate is queried.
+        """
+
+        table = self._aggr_space
+        if (table is not None and self._fresh(self._aggr_space_time) and
+            name in table.names):
+            return table.row(table.names.index(name))
+
+        out = self.invoke('aggr-list-info', 'aggregate', name)
+        return self._parse_aggr_space(
+            out.child_get('aggregates').child_get('aggr-info'))
+
+    def _get_export_rule(self, path):
+        """
+        Return the rule dict for NFS export path, or None if not exported.
+
+        Export table data is used if fresh; otherwise just this path is
+        queried and its table entry updated.
+        """
+
+        rule = self._exports.get(path)
+        if rule is not None:
+            return rule
+        if self._exports.contains(path) is False:
+            return None
+
+        now = time.time()
+        out = self.invoke('nfs-exportfs-list-rules', 'pathname', path)
+        rules = out.child_get('rules')
+        if not rules or not rules.child_get('exports-rule-info'):
+            return None
+        rule = self._parse_export_rule(rules.child_get('exports-rule-info'))
+        self._exports.set(now, path, rule)
+        return rule
+
+    def _get_share(self, name):
+        """
+        Return the configuration dict for CIFS share name, or None.
+
+        Share table data is used if fresh; otherwise just this share is
+        queried and its table entry updated.
+        """
+
+        share = self._shares.get(name)
+        if share is not None:
+            return share
+        if self._shares.contains(name) is False:
+            return None
+
+        now = time.time()
+        out = self.invoke_cli('cifs', 'shares', name)
+        shares = self._parse_cifs_shares(
+            out.child_get('cli-output').element['content'])
+        if name not in shares:
+            return None
+        self._shares.set(now, name, shares[name])
+        return shares[name]
+
+    def _get_snapshot_catalog(self, volume, refresh=False):
+        """
+        Return the SnapshotCatalog of volume, loading it if not fresh.
+        """
+
+        if (not refresh and volume in self._snapshots and
+            self._fresh(self._snapshots[volume][0])):
+            return self._snapshots[volume][1]
+
+        now = time.time()
+        out = self.invoke('snapshot-list-info',
+                          'target-name', volume,
+                          'target-type', 'volume')
+        catalog = SnapshotCatalog(
+            [self._parse_snapshot_info(s)
+             for s in out.child_get('snapshots').children_get()])
+        self._snapshots[volume] = (now, catalog)
+        return catalog
+
+    def _get_volume_info(self, name):
+        """
+        Return the volume-info dict for volume name.
+
+        Inventory data is used if fresh; otherwise just this volume is
+        queried and its inventory entry updated.
+        """
+
+        info = self._volumes.get(name)
+        if info is not None:
+            return info
+
+        now = time.time()
+        out = self.invoke('volume-list-info', 'volume', name)
+        info = self._parse_volume_info(
+            out.child_get('volumes').child_get('volume-info'))
+        self._volumes.set(now, name, info)
+        return info
+
+    def _invoke(self, api, args, call, *call_args):
+        """
+        Make an API call via call(*call_args), raising on failure.
+
+        api and args (the call's name/value pairs or CLI arguments) are
+        used to answer and maintain self.response_cache, and to report
+        the call to self.invoke_hooks.  With self.limiter, the call first
+        waits for a slot.
+        """
+
+        cache = self.response_cache
+        if cache:
+            key = (self.name, api) + tuple([str(a) for a in args])
+            out = cache.get(key)
+            if out is not None:
+                return out
+
+        limiter = self.limiter
+        if limiter:
+            start = limiter.acquire()
+        else:
+            start = time.time()
+        out = None
+        try:
+            out = call(*call_args)
+        finally:
+            if limiter:
+                limiter.release(api, args, start, out)
+            if self.invoke_hooks:
+                self._run_invoke_hooks(api, args, call_args, out,
+                                       time.time() - start)
+
+        if cache:
+            cache.update(key, out)
+        if out.results_status() == 'failed':
+            raise OntapApiException(out.results_errno(), out.results_reason())
+        return out
+
+    def _parse_aggr_space(self, aggr):
+        """Return the fs-space-info dict of an aggr-info element."""
+
+        space_info = aggr.child_get('aggregate-space-details').child_get(
+            'aggregate-space-info').child_get('aggregate-space').child_get(
+            'fs-space-info')
+        return Aggr(self, aggr.child_get_string('name')).parse_space_info(
+            space_info)
+
+    def _parse_cifs_shares(self, output):
+        """
+        Parse 'cifs shares' CLI output into a dict of shares, keyed by name.
+
+        Output is two header lines followed, for each share, by a line
+        starting at the left-hand side with the share name, mount point
+        and description, then indented option ('... name=value') and ACL
+        ('user / rights') lines.  Share names may include whitespace, so
+        the mount point is presumed to start at the first '/' following
+        whitespace.
+        """
+
+        share_pattern = re.compile(r'^(\S.*?)\s+(/\S*)(?:\s+(.*?))?\s*$')
+        option_pattern = re.compile(r'^\s+\.\.\. (.*)$')
+        acl_pattern = re.compile(r'^\s+(.*) / (Full Control|Change|Read)$')
+
+        shares = {}
+        share = None
+
+        for line in output.splitlines()[2:]:
+            m = share_pattern.match(line)
+            if m:
+                share = {'name': m.groups()[0],
+                         'mount-point': m.groups()[1],
+                         'description': m.groups()[2] or False,
+                         'dir_umask': False,
+                         'file_umask': False,
+                         'forcegroup': False,
+                         'umask': False,
+                         'options': [],
+                         'access': {}}
+                shares[share['name']] = share
+                continue
+            if share is None:
+                continue
+
+            m = option_pattern.match(line)
+            if m:
+                option = m.groups()[0].split('=', 1)
+                if len(option) == 2 and option[0] in share:
+                    share[option[0]] = option[1]
+                else:
+                    share['options'].append(m.groups()[0])
+                continue
+
+            m = acl_pattern.match(line)
+            if m:
+                share['access'][m.groups()[0]] = m.groups()[1]
+
+        return shares
+
+    def _parse_export_rule(self, export):
+        """Convert an 'exports-rule-info' NaElement into a dict."""
+
+        rule = {}
+        rule['pathname'] = export.child_get_string('pathname')
+        rule['nosuid'] = (export.child_get_string('nosuid') == 'true')
+        for hosts in ('read-only', 'read-write', 'root'):
+            rule[hosts] = self._xmltree_to_list(export, hosts, 'name')
+
+        rule['sec-flavor'] = None
+        flavors = export.child_get('sec-flavor')
+        if flavors and flavors.child_get('sec-flavor-info'):
+            rule['sec-flavor'] = flavors.child_get(
+                'sec-flavor-info').child_get_string('flavor')
+
+        return rule
+
+    def _parse_perf_counters(self, info, inst):
+        """Convert an 'instance-data' NaElement into a dict of counters."""
+
+        counters = {}
+        for c in inst.child_get('counters').children_get():
+            name = c.child_get_string('name')
+            if info[name]['type'] == 'array':
+                vals = c.child_get_string('value').split(',')
+                data = {}
+                j = 0
+                while j < len(vals):
+                    data[info[name]['labels'][j]] = int(vals[j])
+                    j = j + 1
+                counters[name] = data
+            else:
+                try:
+                    counters[name] = c.child_get_int('value')
+                except ValueError:
+                    # Must be a string...
+                    counters[name] = c.child_get_string('value')
+
+        return counters
+
+    def _parse_snapshot_info(self, snapshot):
+        """Convert a snapshot-info element to a dict."""
+
+        return {'name': snapshot.child_get_string('name'),
+                'access-time': snapshot.child_get_int('access-time'),
+                'busy': snapshot.child_get_string('busy') == 'true',
+                'dependency': snapshot.child_get_string('dependency'),
+                'total': snapshot.child_get_int('total'),
+                'cumulative-total': snapshot.child_get_int('cumulative-total')}
+
+    def _parse_volume_info(self, volume):
+        """Convert a 'volume-info' NaElement into a dict of its scalars."""
+
+        # volume-info fields that should be integers; the rest are strings:
+        int_values = ('files-total', 'files-used', 'percentage-used',
+                      'reserve', 'reserve-required', 'reserve-used',
+                      'reserve-used-actual', 'size-available', 'size-total',
+                      'size-used', 'snapshot-blocks-reserved',
+                      'snapshot-percent-reserved')
+
+        info = {}
+        for field in volume.children_get():
+            if field.has_children():
+                continue
+            name = field.element['name']
+            if name in int_values:
+                info[name] = volume.child_get_int(name)
+            else:
+                info[name] = field.element['content']
+
+        return info
+
+    def _run_invoke_hooks(self, api, args, call_args, out, seconds):
+        """Report a completed call to each of self.invoke_hooks."""
+
+        if isinstance(call_args[0], basestring):
+            request = NaElement(api)
+            for i in range(0, len(args) - 1, 2):
+                request.child_add(NaElement(args[i], args[i + 1]))
+        else:
+            request = call_args[0]
+
+        if out is None:
+            errno = 'exception'
+            response_bytes = 0
+        else:
+            errno = None
+            if out.results_status() == 'failed':
+                errno = out.results_errno()
+            response_bytes = len(out.sprintf())
+
+        event = {'filer': self.name,
+                 'api': api,
+                 'seconds': seconds,
+                 'request-bytes': len(request.sprintf()),
+                 'response-bytes': response_bytes,
+                 'errno': errno}
+        for hook in self.invoke_hooks:
+            hook(event)
+
     def _xmltree_to_dict(self, out, int_values=(), key='name', value='value'):
         """Convert thinly-veiled XML from ONTAP API to a dict."""
         options = {}
@@ -401,55 +1092,678 @@ class Filer:
         return out_list
 
 
+class AdaptiveLimiter:
+    """
+    Limit the API calls in flight to one filer, adapting to its load.
+
+    The limit follows additive-increase/multiplicative-decrease.  Each
+    call that completes promptly raises it by 1/limit, or about one per
+    round of calls.  A call that raises, fails with one of
+    'overload_errnos', or takes more than 'tolerance' times the usual
+    latency of its kind of request cuts the limit by the factor
+    'backoff'; calls already in flight when the limit is cut do not cut
+    it again.
+
+    Requests are of the same kind if they call the same API with the
+    same argument names (for system-cli, the same command), so that
+    e.g. listing one volume is not compared with listing them all.  The
+    usual latency of each kind is a moving average, which is only
+    trusted once 'warmup' calls of that kind have completed.
+
+    Calls beyond the limit wait in acquire() until others complete.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, tolerance=2.0,
+                 backoff=0.5, overload_errnos=('13001',), warmup=5,
+                 smoothing=0.1):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.overload_errnos = overload_errnos
+        self.warmup = warmup
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.latency = {}
+        self.last_cut = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot; return the time the call may start."""
+
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight = self.in_flight + 1
+        return time.time()
+
+    def release(self, api, args, start, out):
+        """
+        Free the slot of a call begun at start, and adapt the limit.
+
+        api and args are the call's name and name/value pairs (or CLI
+        arguments); out is its 'results' element, or None if it raised.
+        """
+
+        now = time.time()
+        seconds = now - start
+        kind = self._kind(api, args)
+
+        if out is None:
+            overloaded = True
+        else:
+            overloaded = (out.results_status() == 'failed' and
+                          out.results_errno() in self.overload_errnos)
+
+        with self.cond:
+            self.in_flight = self.in_flight - 1
+
+            count, usual = self.latency.get(kind, (0, seconds))
+            if not overloaded and out is not None and count >= self.warmup:
+                overloaded = seconds > self.tolerance * usual
+            self.latency[kind] = (count + 1,
+                                  usual + (seconds - usual) * self.smoothing)
+
+            if overloaded:
+                if start > self.last_cut:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.last_cut = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.cond.notify_all()
+
+    def _kind(self, api, args):
+        """Return a key for requests like the call of api with args."""
+
+        if api == 'system-cli':
+            return (api,) + tuple(args[:2])
+        return (api,) + tuple(args[0::2])
+
+
 class Aggr:
     """An aggregate on a NetApp filer."""
 
+    # The fs-space-info fields returned by get_space:
+    space_fields = ('fs-size-total', 'fs-size-used', 'fs-size-available',
+                    'fs-percent-used-capacity', 'fs-files-total',
+                    'fs-files-used', 'fs-percent-inode-used-capacity',
+                    'fs-maxfiles-available', 'fs-maxfiles-used',
+                    'fs-maxfiles-possible', 'fs-files-private-used',
+                    'fs-inodefile-public-capacity',
+                    'fs-inodefile-private-capacity', 'fs-sis-percent-saved',
+                    'fs-sis-shared-space', 'fs-sis-saved-space')
+
     def __init__(self, filer, name):
         self.filer = filer
         self.name = name
 
     def get_space(self):
+        """
+        Return a dict of the aggregate's fs-space-info fields.
 
-        out = self.filer.invoke('aggr-list-info', 'aggregate', self.name)
-        space_info = out.child_get('aggregates').child_get('aggr-info').child_get('aggregate-space-details').child_get('aggregate-space-info').child_get('aggregate-space').child_get('fs-space-info')
+        The filer's aggregate space table is used if fresh; otherwise
+        just this aggregate is queried.
+        """
 
-        return self.parse_space_info(space_info)
+        return self.filer._get_aggr_space(self.name)
 
     def parse_space_info(self, space_info):
         """Parse ONTAP fs-space-info, return dict with contents."""
 
-        info = {}
-        info['fs-size-total'] = space_info.child_get_int('fs-size-total')
-        info['fs-size-used'] = space_info.child_get_int('fs-size-used')
-        info['fs-size-available'] = space_info.child_get_int(
-            'fs-size-available')
-        info['fs-percent-used-capacity'] = space_info.child_get_int(
-            'fs-percent-used-capacity')
-        info['fs-files-total'] = space_info.child_get_int('fs-files-total')
-        info['fs-files-used'] = space_info.child_get_int('fs-files-used')
-        info['fs-percent-inode-used-capacity'] = space_info.child_get_int(
-            'fs-percent-inode-used-capacity')
-        info['fs-maxfiles-available'] = space_info.child_get_int(
-            'fs-maxfiles-available')
-        info['fs-maxfiles-used'] = space_info.child_get_int(
-            'fs-maxfiles-used')
-        info['fs-maxfiles-possible'] = space_info.child_get_int(
-            'fs-maxfiles-possible')
-        info['fs-files-private-used'] = space_info.child_get_int(
-            'fs-files-private-used')
-        info['fs-inodefile-public-capacity'] = space_info.child_get_int(
-            'fs-inodefile-public-capacity')
-        info['fs-inodefile-private-capacity'] = space_info.child_get_int(
-            'fs-inodefile-private-capacity')
-        info['fs-sis-percent-saved'] = space_info.child_get_int(
-            'fs-sis-percent-saved')
-        info['fs-sis-shared-space'] = space_info.child_get_int(
-            'fs-sis-shared-space')
-        info['fs-sis-saved-space'] = space_info.child_get_int(
-            'fs-sis-saved-space')
+        info = {}
+        for field in self.space_fields:
+            info[field] = space_info.child_get_int(field)
+
+        return info
+
+
+class AggrSpaceTable:
+    """
+    Space details of many aggregates, stored by column.
+
+    For each of Aggr.space_fields, columns[field] is an array of floats
+    with one entry per aggregate, in the order of 'names' (aggregate
+    names) and 'filers' (their filers' names); missing values are NaN.
+    Tables from several filers can be combined with merge() so that
+    fleet-wide totals and percentiles need no per-aggregate calls.
+    """
+
+    def __init__(self, filers=[], names=[], rows=[]):
+        self.filers = list(filers)
+        self.names = list(names)
+        self.columns = {}
+        for field in Aggr.space_fields:
+            column = array('d')
+            for row in rows:
+                value = row.get(field)
+                if value is None:
+                    column.append(NAN)
+                else:
+                    column.append(value)
+            self.columns[field] = column
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def merge(cls, tables):
+        """Return a new table with the rows of each of tables."""
+
+        merged = cls()
+        for table in tables:
+            merged.filers.extend(table.filers)
+            merged.names.extend(table.names)
+            for field in Aggr.space_fields:
+                merged.columns[field].extend(table.columns[field])
+        return merged
+
+    def percentile(self, field, percent):
+        """
+        Return the percent'th percentile of field over all aggregates,
+        interpolating between values; NaN if there are none.
+        """
+
+        values = sorted([v for v in self.columns[field] if v == v])
+        if not values:
+            return NAN
+        rank = (len(values) - 1) * percent / 100.0
+        low = int(rank)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (rank - low)
+
+    def row(self, index):
+        """Return the fs-space-info dict of the index'th aggregate."""
+
+        info = {}
+        for field in Aggr.space_fields:
+            value = self.columns[field][index]
+            if value == value:
+                info[field] = int(value)
+            else:
+                info[field] = None
+        return info
+
+    def total(self, field):
+        """Return the sum of field over all aggregates, ignoring NaNs."""
+
+        return sum([v for v in self.columns[field] if v == v])
+
+
+class AutosizeRemediator:
+    """
+    Grow the nearly full volumes of a FilerPool's filers within their
+    autosize limits.
+
+    A volume is at risk when online with percentage-used of at least
+    'threshold', or, if 'min_available' is given, fewer than that many
+    bytes available.  As in the netapp-force-autosize example, an at-risk
+    volume is grown by its autosize increment, or to its autosize
+    maximum if that is nearer; volumes at their maximum are left alone,
+    as are those with autosize disabled if 'enabled_only' is True.
+
+    The plan is made from each filer's volume inventory plus one
+    volume-autosize-get and one volume-size call per at-risk volume,
+    with filers read concurrently; resizes run concurrently within the
+    pool's per-filer limit.
+    """
+
+    def __init__(self, pool, threshold=95, min_available=None,
+                 enabled_only=False):
+        self.pool = pool
+        self.threshold = threshold
+        self.min_available = min_available
+        self.enabled_only = enabled_only
+        self.errors = {}
+
+    def plan(self):
+        """
+        Return a list of at-risk volumes and how each would be grown.
+
+        Each entry is a dict with these keys:
+
+        filer, volume - names
+        percentage-used, size-available - from the volume inventory
+        size - current size, in KB
+        is-enabled, increment-size, maximum-size - autosize settings,
+                                                   sizes in KB
+        new-size - argument for FlexVol.set_size, or None if the volume
+                   cannot be grown
+
+        Filers that could not be read are left out, and their exceptions
+        stored in self.errors, keyed by filer name.
+        """
+
+        self.errors = {}
+        names = sorted(self.pool.filers)
+        results = self.pool.run([(name, self._plan_filer) for name in names])
+
+        plan = []
+        for name, result in zip(names, results):
+            try:
+                plan.extend(result.get())
+            except Exception as e:
+                self.errors[name] = e
+        return plan
+
+    def remediate(self, dry_run=False):
+        """
+        Grow the volumes in plan(); return the plan.
+
+        Each entry gains a 'result' key: 'grown', 'at-maximum' or
+        'disabled' (left alone), 'dry-run' (if dry_run is True, nothing
+        is resized) or 'failed', in which case 'error' holds the
+        exception raised.
+        """
+
+        plan = self.plan()
+
+        tasks = []
+        for entry in plan:
+            entry['error'] = None
+            if entry['new-size'] is None:
+                if self.enabled_only and not entry['is-enabled']:
+                    entry['result'] = 'disabled'
+                else:
+                    entry['result'] = 'at-maximum'
+            elif dry_run:
+                entry['result'] = 'dry-run'
+            else:
+                tasks.append(entry)
+
+        results = self.pool.run([(entry['filer'], self._grow,
+                                  (entry['volume'], entry['new-size']))
+                                 for entry in tasks])
+        for entry, result in zip(tasks, results):
+            entry['error'] = result.error
+            if result.error:
+                entry['result'] = 'failed'
+            else:
+                entry['result'] = 'grown'
+
+        return plan
+
+    def _at_risk(self, info):
+        """Return True if the volume described by info needs to grow."""
+
+        if info.get('state') != 'online':
+            return False
+        if info.get('percentage-used', 0) >= self.threshold:
+            return True
+        return (self.min_available is not None and
+                info.get('size-available') is not None and
+                info['size-available'] < self.min_available)
+
+    def _grow(self, filer, volume, new_size):
+        """Resize volume on filer to new_size."""
+
+        FlexVol(filer, volume).set_size(new_size)
+
+    def _new_size(self, entry):
+        """Return the set_size argument that grows entry, or None."""
+
+        if self.enabled_only and not entry['is-enabled']:
+            return None
+        increment = entry['increment-size']
+        maximum = entry['maximum-size']
+        if increment is None or maximum is None or entry['size'] >= maximum:
+            return None
+        if entry['size'] + increment > maximum:
+            return str(maximum)
+        return '+%ik' % increment
+
+    def _plan_filer(self, filer):
+        """Return the plan entries of filer's at-risk volumes."""
+
+        inventory = filer.get_volume_inventory(refresh=True)
+        volumes = sorted([name for name, info in inventory.items()
+                          if self._at_risk(info)])
+        if not volumes:
+            return []
+
+        autosizes = filer.get_autosize(volumes,
+                                       max_workers=self.pool.per_filer_limit)
+        sizes = _parallel_map(lambda name: FlexVol(filer, name).get_size(),
+                              volumes, self.pool.per_filer_limit)
+
+        plan = []
+        for name, (size, error) in zip(volumes, sizes):
+            if error:
+                raise error
+            autosize = autosizes[name]
+            entry = {'filer': filer.name,
+                     'volume': name,
+                     'percentage-used': inventory[name]['percentage-used'],
+                     'size-available': inventory[name]['size-available'],
+                     'size': self._size_in_kb(size),
+                     'is-enabled': autosize.get('is-enabled'),
+                     'increment-size': autosize.get('increment-size'),
+                     'maximum-size': autosize.get('maximum-size')}
+            entry['new-size'] = self._new_size(entry)
+            plan.append(entry)
+        return plan
+
+    def _size_in_kb(self, size):
+        """Convert a volume-size string, e.g. '500g', to kilobytes."""
+
+        scale = {'k': 1, 'm': 1024, 'g': 1024 ** 2, 't': 1024 ** 3}
+        if size[-1] in scale:
+            return int(size[:-1]) * scale[size[-1]]
+        return int(size)
+
+
+class CallResult:
+    """
+    The outcome of a call made on a caller's behalf, e.g. by FilerPool.
+
+    Exactly one of 'result' and 'error' (the exception raised) is set.
+    """
+
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def get(self):
+        """Return the call's result, or raise the exception it raised."""
+
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CapacityCollector:
+    """
+    Periodically record the capacity of every volume and aggregate of a
+    FilerPool's filers into a CapacityStore.
+
+    Each filer's volume inventory and aggregate space table are loaded
+    concurrently, so a collection costs two API calls per filer.
+    """
+
+    def __init__(self, pool, store):
+        self.pool = pool
+        self.store = store
+
+    def collect(self):
+        """
+        Record one sample of every object; return a dict of exceptions
+        raised by filers that could not be read, keyed by filer name.
+        """
+
+        now = time.time()
+        results = self.pool.map(self._read)
+
+        samples = {}
+        errors = {}
+        for name, result in results.items():
+            try:
+                samples.update(result.get())
+            except Exception as e:
+                errors[name] = e
+
+        self.store.append(now, samples)
+        return errors
+
+    def run(self, interval, count=None):
+        """
+        Collect every 'interval' seconds, 'count' times or forever.
+        """
+
+        i = 0
+        while count is None or i < count:
+            start = time.time()
+            self.collect()
+            i = i + 1
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def _read(self, filer):
+        """Return filer's capacity samples, keyed as for CapacityStore."""
+
+        samples = {}
+        for name, info in filer.get_volume_inventory().items():
+            samples[('volume', filer.name, name)] = {
+                'used': info.get('size-used'),
+                'available': info.get('size-available'),
+                'total': info.get('size-total')}
+
+        table = filer.get_aggr_space_table()
+        for i, name in enumerate(table.names):
+            info = table.row(i)
+            samples[('aggr', filer.name, name)] = {
+                'used': info['fs-size-used'],
+                'available': info['fs-size-available'],
+                'total': info['fs-size-total']}
+
+        return samples
+
+
+class CapacityStore:
+    """
+    An append-only, on-disk time series of volume and aggregate capacity.
+
+    Objects are keyed by (kind, filer, name) tuples, where kind is
+    'volume' or 'aggr'; objects.txt numbers them.  Under the directory
+    'path', each object's samples are appended to a file of its own
+    (<number>.f64) as records of native doubles: the timestamp, the
+    used, available and total bytes, then running sums of the fit of
+    used space against time in days since the object's first sample
+    (count, sum of t, of used, of t squared and of t times used).
+
+    The running sums let forecast() fit any window of history from the
+    window's first and last records alone, so its cost grows with the
+    number of objects, not samples: the last records are kept in
+    memory, and a window's first is found by bisecting the object's
+    file through mmap.  Samples must be appended in time order, and
+    there should be only one writer at a time.
+    """
+
+    fields = ('timestamp', 'used', 'available', 'total',
+              'count', 'sum-t', 'sum-v', 'sum-tt', 'sum-tv')
+    record_size = len(fields) * array('d').itemsize
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.objects = []
+        self.index = {}
+        self.origins = []
+        self.last = []
+        objects = os.path.join(path, 'objects.txt')
+        if os.path.exists(objects):
+            f = open(objects)
+            for line in f:
+                self._add_object(tuple(line.rstrip('\n').split('\t')))
+            f.close()
+
+        for j in range(len(self.objects)):
+            if (not os.path.exists(self._file(j)) or
+                os.path.getsize(self._file(j)) < self.record_size):
+                continue
+            f = open(self._file(j), 'rb')
+            first = array('d')
+            first.fromstring(f.read(self.record_size))
+            f.seek(-self.record_size, os.SEEK_END)
+            last = array('d')
+            last.fromstring(f.read(self.record_size))
+            f.close()
+            self.origins[j] = first[0]
+            self.last[j] = last
+
+    def append(self, timestamp, samples):
+        """
+        Record samples taken at timestamp.
+
+        samples is a dict, keyed by (kind, filer, name), of dicts with
+        'used', 'available' and 'total' values in bytes.  Samples
+        without a used value are skipped; other missing values are
+        stored as NaN.
+        """
+
+        with self.lock:
+            new = [key for key in sorted(samples)
+                   if key not in self.index and
+                   samples[key].get('used') is not None]
+            if new:
+                f = open(os.path.join(self.path, 'objects.txt'), 'a')
+                for key in new:
+                    self._add_object(key)
+                    f.write('\t'.join(key) + '\n')
+                f.close()
+
+            for key in sorted(samples):
+                sample = samples[key]
+                if sample.get('used') is None:
+                    continue
+                j = self.index[key]
+
+                if self.origins[j] is None:
+                    self.origins[j] = timestamp
+                    sums = (0, 0, 0, 0, 0)
+                else:
+                    sums = self.last[j][4:]
+                t = (timestamp - self.origins[j]) / 86400.0
+                v = sample['used']
+                record = array('d', [timestamp, v])
+                for metric in ('available', 'total'):
+                    if sample.get(metric) is None:
+                        record.append(NAN)
+                    else:
+                        record.append(sample[metric])
+                record.extend((sums[0] + 1, sums[1] + t, sums[2] + v,
+                               sums[3] + t * t, sums[4] + t * v))
+
+                f = open(self._file(j), 'ab')
+                f.write(record.tostring())
+                f.close()
+                self.last[j] = record
+
+    def forecast(self, kind='volume', since=0, now=None):
+        """
+        Fit each object's growth since 'since'; project when it fills.
+
+        Used space is fitted against time by least squares.  Return a
+        dict, keyed by (kind, filer, name), of dicts with these keys:
+
+        samples - number of samples in the window
+        used, available - latest values, in bytes
+        growth-per-day - fitted growth of used space, in bytes per day
+        days-to-full - days from 'now' (default: the latest sample)
+                       until available space runs out at that rate;
+                       infinite if not growing, NaN if under 2 samples
+
+        Objects with no samples in the window are left out.
+        """
+
+        forecasts = {}
+        for j, key in enumerate(self.objects):
+            last = self.last[j]
+            if key[0] != kind or last is None or last[0] < since:
+                continue
+
+            sums = list(last[4:])
+            if since > self.origins[j]:
+                i = self._bisect(j, since)
+                if i:
+                    before = self._read(j, i - 1, i)
+                    sums = [a - b for a, b in zip(sums, before[4:])]
+            n, sum_t, sum_v, sum_tt, sum_tv = sums
+
+            growth = NAN
+            days = NAN
+            denominator = n * sum_tt - sum_t * sum_t
+            if n >= 2 and denominator > 0:
+                growth = (n * sum_tv - sum_t * sum_v) / denominator
+                if growth > 0:
+                    days = last[2] / growth
+                    if now is not None:
+                        days = days - (now - last[0]) / 86400.0
+                else:
+                    days = float('inf')
+
+            forecasts[key] = {'samples': int(round(n)),
+                              'used': last[1],
+                              'available': last[2],
+                              'growth-per-day': growth,
+                              'days-to-full': days}
+        return forecasts
+
+    def series(self, key, metric, since=0):
+        """
+        Return (timestamps, values) arrays of one object's metric
+        ('used', 'available' or 'total') since 'since'.
+        """
+
+        timestamps = array('d')
+        values = array('d')
+        if key not in self.index:
+            return (timestamps, values)
+
+        j = self.index[key]
+        if self.last[j] is None:
+            return (timestamps, values)
+        column = self.fields.index(metric)
+        records = self._read(j, self._bisect(j, since))
+        width = len(self.fields)
+        timestamps.extend(records[0::width])
+        values.extend(records[column::width])
+        return (timestamps, values)
+
+    def _add_object(self, key):
+        """Number a new (kind, filer, name) key."""
+
+        self.index[key] = len(self.objects)
+        self.objects.append(key)
+        self.origins.append(None)
+        self.last.append(None)
+
+    def _bisect(self, j, since):
+        """Return the number of object j's first record at or after since."""
+
+        if self.last[j] is None:
+            return 0
+        f = open(self._file(j), 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            lo = 0
+            hi = len(m) // self.record_size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                offset = mid * self.record_size
+                if struct.unpack_from('d', m, offset)[0] < since:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        finally:
+            m.close()
+        return lo
+
+    def _file(self, j):
+        """Return the path of object j's file."""
+
+        return os.path.join(self.path, '%d.f64' % j)
+
+    def _read(self, j, start, end=None):
+        """Return object j's records start to end, flattened into doubles."""
+
+        f = open(self._file(j), 'rb')
+        f.seek(start * self.record_size)
+        if end is None:
+            data = f.read()
+        else:
+            data = f.read((end - start) * self.record_size)
+        f.close()
+
+        records = array('d')
+        records.fromstring(data)
+        return records
 
-        return info
-        
 
 class Export:
     """An NFS export on a NetApp Filer."""
@@ -516,6 +1830,7 @@ class Export:
 
         # Execute rule change:
         self.filer.invoke_elem(nfs_export)
+        self.filer._forget_export(self.path, listing=True)
 
     def delete_rule(self):
         """Remove the exportfs rule for a share."""
@@ -536,6 +1851,7 @@ class Export:
 
         # Execute it:
         self.filer.invoke_elem(elem)
+        self.filer._forget_export(self.path, listing=True)
 
     def get_nosuid(self):
         """
@@ -548,15 +1864,9 @@ class Export:
         If export does not exist, return an empty string.
         """
 
-        rules = self._get_rules()
-        if rules:
-            if rules.child_get('nosuid'):
-                if rules.child_get_string('nosuid') == 'true':
-                    return True
-                else:
-                    return False
-            else:
-                return False
+        rule = self._get_rules()
+        if rule:
+            return rule['nosuid']
         else:
             return ''
 
@@ -567,30 +1877,26 @@ class Export:
         If export does not exist, return an empty list.
         """
 
-        rules = self._get_rules()
-        if rules:
-            return self.filer._xmltree_to_list(rules, 'read-only', 'name')
+        rule = self._get_rules()
+        if rule:
+            return rule['read-only']
         else:
             return []
 
     def get_rw_hosts(self):
         """Return list of hosts permitted read/write access."""
 
-        rules = self._get_rules()
-        return self.filer._xmltree_to_list(rules, 'read-write', 'name')
+        return self._get_rules()['read-write']
 
     def get_root_hosts(self):
         """Return list of hosts permitted root access."""
 
-        rules = self._get_rules()
-        return self.filer._xmltree_to_list(rules, 'root', 'name')
+        return self._get_rules()['root']
 
     def get_sec_flavor(self):
         """Return the security 'flavor' of the NFS export."""
 
-        rules = self._get_rules()
-        return rules.child_get('sec-flavor').child_get(
-            'sec-flavor-info').child_get_string('flavor')
+        return self._get_rules()['sec-flavor']
 
     def modify_rule(self, nosuid=True, root_hosts = [], ro_hosts = [],
                     rw_hosts = [], sec_flavor = 'sys'):
@@ -641,22 +1947,149 @@ class Export:
 
         # Execute rule change:
         self.filer.invoke_elem(nfs_export)
+        self.filer._forget_export(self.path)
 
     def _get_rules(self):
         """
-        Return an NaElement containing the 'exports-rule-info'.
+        Return a dict of the export's rule, as in Filer.get_export_table.
 
         If there is no 'exports-rule-info', return False.
         """
 
-        out = self.filer.invoke('nfs-exportfs-list-rules',
-                                'pathname', self.path)
-        try:
-            return out.child_get('rules').child_get('exports-rule-info')
-        except AttributeError:
+        rule = self.filer._get_export_rule(self.path)
+        if rule is None:
             return False
-        else:
-            raise
+        return rule
+
+class FilerPool:
+    """
+    A set of Filers, operated on concurrently.
+
+    Calls are spread over up to 'max_workers' threads, with at most
+    'per_filer_limit' calls in flight to any one filer.  Results are
+    reported per call as CallResult objects, so that one failing filer
+    doesn't stop a fleet-wide sweep.
+    """
+
+    def __init__(self, filers=[], max_workers=16, per_filer_limit=4):
+        self.max_workers = max_workers
+        self.per_filer_limit = per_filer_limit
+        self.filers = {}
+        self.running = {}
+        self.cond = threading.Condition()
+        for filer in filers:
+            self.add(filer)
+
+    def add(self, filer):
+        """Add a connected Filer to the pool."""
+
+        with self.cond:
+            self.filers[filer.name] = filer
+            self.running.setdefault(filer.name, 0)
+
+    def connect(self, hosts, probe=True, **kwargs):
+        """
+        Connect to each of hosts in parallel and add them to the pool.
+
+        hosts is a list of dicts with 'hostname', 'user' and 'passwd'
+        keys, as found in the example scripts' YAML files.  Any other
+        keyword arguments are passed to the Filer constructor.
+
+        Unless probe is False, each filer's version is looked up to check
+        that it can be reached.  Return a dict of the exceptions raised by
+        hosts that could not be connected to, keyed by hostname.
+        """
+
+        def connect(host):
+            filer = Filer(host['hostname'], host['user'], host['passwd'],
+                          **kwargs)
+            if probe:
+                filer.version
+            return filer
+
+        errors = {}
+        for host, (filer, error) in zip(hosts, _parallel_map(
+                connect, hosts, self.max_workers)):
+            if error:
+                errors[host['hostname']] = error
+            else:
+                self.add(filer)
+        return errors
+
+    def invoke(self, *args):
+        """Call Filer.invoke(*args) on every filer; see map()."""
+
+        return self.map(lambda filer: filer.invoke(*args))
+
+    def map(self, func):
+        """
+        Call func(filer) for every filer in the pool.
+
+        Return a dict of CallResults keyed by filer name.
+        """
+
+        names = sorted(self.filers)
+        results = self.run([(name, func) for name in names])
+        return dict(zip(names, results))
+
+    def run(self, tasks):
+        """
+        Run a list of (filer name, func[, args]) tasks concurrently.
+
+        Each task calls func(filer, *args), honoring the pool's
+        per-filer limit.  Tasks are queued per filer, and a free worker
+        takes the next task of any filer below its limit, so a long
+        queue for one filer does not hold up the others.  Return a list
+        of CallResults in task order.
+        """
+
+        results = [None] * len(tasks)
+        pending = collections.OrderedDict()
+        for i, task in enumerate(tasks):
+            if task[0] in self.filers:
+                pending.setdefault(task[0], collections.deque()).append(i)
+            else:
+                results[i] = CallResult(error=KeyError(task[0]))
+
+        def next_task():
+            """Claim the next runnable task's index, or None if done."""
+
+            with self.cond:
+                while pending:
+                    for name in pending:
+                        if self.running[name] < self.per_filer_limit:
+                            i = pending[name].popleft()
+                            if not pending[name]:
+                                del pending[name]
+                            self.running[name] = self.running[name] + 1
+                            return i
+                    self.cond.wait()
+            return None
+
+        def worker(n):
+            while True:
+                i = next_task()
+                if i is None:
+                    return
+                task = tasks[i]
+                if len(task) > 2:
+                    args = task[2]
+                else:
+                    args = ()
+                try:
+                    results[i] = CallResult(
+                        task[1](self.filers[task[0]], *args))
+                except Exception as e:
+                    results[i] = CallResult(error=e)
+                finally:
+                    with self.cond:
+                        self.running[task[0]] = self.running[task[0]] - 1
+                        self.cond.notify_all()
+
+        _parallel_map(worker, range(min(self.max_workers, len(tasks))),
+                      self.max_workers)
+        return results
+
 
 class FlexVol:
     """A FlexVol on a NetApp Filer."""
@@ -676,13 +2109,10 @@ class FlexVol:
                           'volume', self.name,
                           'containing-aggr-name', aggr,
                           'size', size)
+        self.filer._forget_volume(self.name, listing=True)
 
     def autosize_is_enabled(self):
-        out = self.filer.invoke('volume-autosize-get', 'volume', self.name)
-        if out.child_get_string('is-enabled') == 'true':
-            return True
-        else:
-            return False
+        return self.get_autosize()['is-enabled']
 
 
     def sis_is_enabled(self):
@@ -714,9 +2144,37 @@ class FlexVol:
                           'schedule-name', schedule_name,
                           'volume-name', self.name)
         
-    def get_autosize_increment(self):
+    def get_autosize(self):
+        """
+        Return all autosize settings from one volume-autosize-get call.
+
+        The dict returned holds each field of the API's output, e.g.:
+
+        is-enabled - boolean
+        increment-size - Increment by which the volume grows, in KB
+        maximum-size - Size to which the volume may grow, in KB
+
+        Other fields reported by the filer (sizes, thresholds, mode) are
+        included as integers or strings.
+        """
+
         out = self.filer.invoke('volume-autosize-get', 'volume', self.name)
-        return out.child_get_int('increment-size')
+
+        autosize = {}
+        for field in out.children_get():
+            name = field.element['name']
+            content = field.element['content']
+            if name == 'is-enabled':
+                autosize[name] = (content == 'true')
+            elif re.match(r'^-?\d+$', content):
+                autosize[name] = int(content)
+            else:
+                autosize[name] = content
+
+        return autosize
+
+    def get_autosize_increment(self):
+        return self.get_autosize()['increment-size']
 
 
     def get_autosize_increment_gb(self):
@@ -731,8 +2189,7 @@ class FlexVol:
         return str(int(round(kb / 1024. / 1024.))) + 'g'
 
     def get_autosize_max_size(self):
-        out = self.filer.invoke('volume-autosize-get', 'volume', self.name)
-        return out.child_get_int('maximum-size')
+        return self.get_autosize()['maximum-size']
 
     def get_autosize_max_size_gb(self):
         """
@@ -754,14 +2211,8 @@ class FlexVol:
         any), similar to how 'df' works on the CLI.
         """
 
-        out = self.filer.invoke('volume-list-info', 'volume', self.name)
-        used = out.child_get('volumes').child_get(
-            'volume-info').child_get_int('size-used')
-        avail = out.child_get('volumes').child_get(
-            'volume-info').child_get_int('size-available')
-        total = out.child_get('volumes').child_get(
-            'volume-info').child_get_int('size-total')
-        return([used, avail, total])
+        info = self.filer._get_volume_info(self.name)
+        return([info['size-used'], info['size-available'], info['size-total']])
 
     def get_options(self):
         """Equivalent to: vol options <self.name>
@@ -870,12 +2321,19 @@ class FlexVol:
 
         return sched
 
+    def get_snapshot_catalog(self, refresh=False):
+        """
+        Return a SnapshotCatalog of FlexVol's snapshots.
+
+        See Filer.get_snapshot_catalogs for when it is reloaded.
+        """
+
+        return self.filer._get_snapshot_catalog(self.name, refresh)
+
     def get_state(self):
         """Return state of the volume (online, offline, restricted, etc.)."""
 
-        out = self.filer.invoke('volume-list-info', 'volume', self.name)
-        return out.child_get('volumes').child_get(
-            'volume-info').child_get_string('state')
+        return self.filer._get_volume_info(self.name)['state']
 
     def get_sv_pri_snap_sched(self):
         """
@@ -952,15 +2410,7 @@ class FlexVol:
     def has_snap(self, snap_name):
         """Return boolean of whether FlexVol has snapshot 'snap_name'."""
 
-        out = self.filer.invoke('snapshot-list-info',
-                                'target-name', self.name,
-                                'target-type', 'volume')
-
-        for s in out.child_get('snapshots').children_get():
-            if s.child_get_string('name') == snap_name:
-                return True
-
-        return False
+        return snap_name in self.get_snapshot_catalog()
 
     def set_autosize_state(self,
                            enabled,
@@ -1042,6 +2492,7 @@ class FlexVol:
         self.filer.invoke('volume-size',
                           'new-size', size,
                           'volume', self.name)
+        self.filer._forget_volume(self.name)
 
     def set_snap_autodelete_option(self, option_name, value):
         """Equivalent to 'snap autodelete <self.name> <option_name> <value>'
@@ -1172,6 +2623,17 @@ class FlexVol:
                           'volume', self.name,
                           'snapshot', snap_name)
 
+        # The filer's creation time and size are not returned, so the
+        # local clock and zero stand in until the catalog is reloaded:
+        catalog = self.filer._cached_snapshot_catalog(self.name)
+        if catalog is not None:
+            catalog.add({'name': snap_name,
+                         'access-time': int(time.time()),
+                         'busy': False,
+                         'dependency': None,
+                         'total': 0,
+                         'cumulative-total': 0})
+
     def snapshot_delete(self, snap_name):
         """Equivalent to 'snap delete <self.name> <snap_name>'."""
 
@@ -1179,6 +2641,10 @@ class FlexVol:
                           'volume', self.name,
                           'snapshot', snap_name)
 
+        catalog = self.filer._cached_snapshot_catalog(self.name)
+        if catalog is not None:
+            catalog.remove(snap_name)
+
     def snapshot_rename(self, current_name, new_name):
         """Equivalent to 'snap rename <self.name> <current_name> <new_name>'"""
 
@@ -1187,6 +2653,10 @@ class FlexVol:
                           'current-name', current_name,
                           'new-name', new_name)
 
+        catalog = self.filer._cached_snapshot_catalog(self.name)
+        if catalog is not None:
+            catalog.rename(current_name, new_name)
+
     def snapvault_primary_snap(self, schedule):
         """
         Equivalent to 'snapvault snap create <self.name> <schedule>'
@@ -1197,6 +2667,7 @@ class FlexVol:
         self.filer.invoke('snapvault-primary-initiate-snapshot-create',
                           'volume-name', self.name,
                            'schedule-name', schedule)
+        self.filer._forget_snapshots(self.name)
 
     def snapvault_secondary_snap(self, schedule):
         """
@@ -1208,8 +2679,1071 @@ class FlexVol:
         self.filer.invoke('snapvault-secondary-initiate-snapshot-create',
                           'volume-name', self.name,
                           'schedule-name', schedule)
+        self.filer._forget_snapshots(self.name)
         
 
+class InventoryTable:
+    """
+    A filer-wide listing, such as of volumes, and its entries.
+
+    The listing (the set of keys) and each entry carry the time they
+    were loaded, and are used while 'fresh(timestamp)' is True.  An
+    entry can be dropped with forget() after a change, and re-fetched
+    alone with set(); values() only answers while every listed entry is
+    fresh, so a changed entry is never silently left out.
+    """
+
+    def __init__(self, fresh):
+        self.fresh = fresh
+        self.entries = {}
+        self.keys = None
+        self.keys_time = 0
+
+    def contains(self, key):
+        """Return whether the listing holds key, or None if not fresh."""
+
+        if self.keys is None or not self.fresh(self.keys_time):
+            return None
+        return key in self.keys
+
+    def forget(self, key, listing=False):
+        """
+        Drop the entry for key.
+
+        If listing is True, the listing is also discarded, e.g. because
+        an entry was created or deleted.
+        """
+
+        self.entries.pop(key, None)
+        if listing:
+            self.keys = None
+
+    def get(self, key):
+        """Return the entry for key, or None if absent or not fresh."""
+
+        if key in self.entries and self.fresh(self.entries[key][0]):
+            return self.entries[key][1]
+        return None
+
+    def load(self, timestamp, entries):
+        """Replace the listing with dict entries, loaded at timestamp."""
+
+        self.entries = dict([(key, (timestamp, value))
+                             for key, value in entries.items()])
+        self.keys = set(entries)
+        self.keys_time = timestamp
+
+    def set(self, timestamp, key, value):
+        """Store the entry for key, loaded at timestamp."""
+
+        self.entries[key] = (timestamp, value)
+
+    def values(self):
+        """
+        Return a dict of every listed entry, or None if the listing or
+        any of its entries must be reloaded.
+        """
+
+        if self.keys is None or not self.fresh(self.keys_time):
+            return None
+
+        values = {}
+        for key in self.keys:
+            value = self.get(key)
+            if value is None:
+                return None
+            values[key] = value
+        return values
+
+
+class InvokeMetrics:
+    """
+    Aggregate Filer invoke events into per-filer, per-API metrics.
+
+    An InvokeMetrics object is a hook for Filer.add_invoke_hook, and may
+    be shared by many Filers.  For each filer and API it counts calls,
+    errors by errno and bytes sent and received, and keeps a latency
+    histogram with upper bounds 'buckets' (in seconds).
+    """
+
+    def __init__(self, buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+                                5, 10)):
+        self.buckets = tuple(sorted(buckets))
+        self.apis = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event['filer'], event['api'])
+        with self.lock:
+            if key not in self.apis:
+                self.apis[key] = {'calls': 0,
+                                  'errors': {},
+                                  'seconds': 0.0,
+                                  'request-bytes': 0,
+                                  'response-bytes': 0,
+                                  'buckets': [0] * len(self.buckets)}
+            m = self.apis[key]
+            m['calls'] = m['calls'] + 1
+            m['seconds'] = m['seconds'] + event['seconds']
+            m['request-bytes'] = m['request-bytes'] + event['request-bytes']
+            m['response-bytes'] = (m['response-bytes'] +
+                                   event['response-bytes'])
+            if event['errno'] is not None:
+                m['errors'][event['errno']] = (
+                    m['errors'].get(event['errno'], 0) + 1)
+            for i in range(len(self.buckets)):
+                if event['seconds'] <= self.buckets[i]:
+                    m['buckets'][i] = m['buckets'][i] + 1
+
+    def reset(self):
+        """Discard all metrics collected so far."""
+
+        with self.lock:
+            self.apis = {}
+
+    def to_json(self):
+        """Return the metrics as a JSON list, one object per filer/API."""
+
+        with self.lock:
+            metrics = []
+            for (filer, api) in sorted(self.apis):
+                m = dict(self.apis[(filer, api)])
+                m['filer'] = filer
+                m['api'] = api
+                m['buckets'] = dict(zip([str(b) for b in self.buckets],
+                                        m['buckets']))
+                metrics.append(m)
+        return json.dumps(metrics, sort_keys=True)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+
+        calls = ['# TYPE ontap_api_calls_total counter']
+        errors = ['# TYPE ontap_api_errors_total counter']
+        sent = ['# TYPE ontap_api_request_bytes_total counter']
+        received = ['# TYPE ontap_api_response_bytes_total counter']
+        latency = ['# TYPE ontap_api_latency_seconds histogram']
+
+        with self.lock:
+            for (filer, api) in sorted(self.apis):
+                m = self.apis[(filer, api)]
+                labels = 'filer="%s",api="%s"' % (filer, api)
+                calls.append('ontap_api_calls_total{%s} %d' %
+                             (labels, m['calls']))
+                for errno in sorted(m['errors']):
+                    errors.append('ontap_api_errors_total{%s,errno="%s"} %d' %
+                                  (labels, errno, m['errors'][errno]))
+                sent.append('ontap_api_request_bytes_total{%s} %d' %
+                            (labels, m['request-bytes']))
+                received.append('ontap_api_response_bytes_total{%s} %d' %
+                                (labels, m['response-bytes']))
+                for bound, count in zip(self.buckets, m['buckets']):
+                    latency.append(
+                        'ontap_api_latency_seconds_bucket{%s,le="%s"} %d' %
+                        (labels, bound, count))
+                latency.append(
+                    'ontap_api_latency_seconds_bucket{%s,le="+Inf"} %d' %
+                    (labels, m['calls']))
+                latency.append('ontap_api_latency_seconds_sum{%s} %f' %
+                               (labels, m['seconds']))
+                latency.append('ontap_api_latency_seconds_count{%s} %d' %
+                               (labels, m['calls']))
+
+        return '\n'.join(calls + errors + sent + received + latency) + '\n'
+
+
+class KeepAliveTransport:
+    """
+    Send ZAPI requests over a pool of persistent HTTP(S) connections.
+
+    This stands in for NaServer (providing invoke and invoke_elem) but
+    reuses connections across calls, saving a TCP and TLS handshake per
+    call.  Up to 'pool_size' idle connections are kept; connections idle
+    for more than 'idle_timeout' seconds, or closed by the filer, are
+    discarded before use.
+
+    Like NaServer, the filer's certificate is not verified unless an
+    ssl 'context' is given.  With 'fast_xml', responses are decoded into
+    ZapiElements rather than NaElements.
+    """
+
+    url = '/servlets/netapp.servlets.admin.XMLrequest_filer'
+
+    def __init__(self, hostname, user, passwd, pool_size=4, idle_timeout=60,
+                 transport_type='HTTPS', port=None, timeout=None,
+                 context=None, fast_xml=False):
+        self.hostname = hostname
+        self.fast_xml = fast_xml
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.transport_type = transport_type
+        self.port = port
+        self.timeout = timeout
+        if context is None and transport_type == 'HTTPS':
+            context = ssl._create_unverified_context()
+        self.context = context
+        self.auth = 'Basic ' + base64.b64encode(user + ':' + passwd)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn, last_used in idle:
+            conn.close()
+
+    def invoke(self, api, *args):
+        """Call api with name/value pairs args; see NaServer.invoke."""
+
+        if len(args) % 2:
+            return self._fail(13001, 'in Zapi::invoke, invalid number of '
+                                     'parameters')
+        nae = NaElement(api)
+        for i in range(0, len(args), 2):
+            nae.child_add(NaElement(args[i], args[i + 1]))
+        return self.invoke_elem(nae)
+
+    def invoke_elem(self, naelement):
+        """Call the API described by naelement; return 'results'."""
+
+        request = ("<?xml version='1.0' encoding='utf-8'?>\n"
+                   "<!DOCTYPE netapp SYSTEM 'file:/etc/netapp_filer.dtd'>\n"
+                   "<netapp version='1.3' "
+                   "xmlns='http://www.netapp.com/filer/admin'>\n" +
+                   naelement.sprintf() + "</netapp>\n")
+
+        try:
+            status, body = self._post(request)
+        except (socket.error, httplib.HTTPException) as e:
+            return self._fail(13001, str(e))
+
+        if status != 200:
+            return self._fail(13001, 'Server returned HTTP status %d' %
+                              status)
+        try:
+            return self._parse(body)
+        except xml.parsers.expat.ExpatError as e:
+            return self._fail(13001, 'Unable to parse response: %s' % e)
+
+    def _checkin(self, conn):
+        """Return a healthy connection to the idle pool."""
+
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def _checkout(self):
+        """
+        Return a (connection, reused) tuple.
+
+        An idle connection that is still usable is preferred; otherwise
+        a new one is made.
+        """
+
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, last_used = self.idle.pop()
+            if (time.time() - last_used < self.idle_timeout and
+                self._is_alive(conn)):
+                return (conn, True)
+            conn.close()
+
+        if self.transport_type == 'HTTPS':
+            conn = httplib.HTTPSConnection(self.hostname, self.port,
+                                           timeout=self.timeout,
+                                           context=self.context)
+        else:
+            conn = httplib.HTTPConnection(self.hostname, self.port,
+                                          timeout=self.timeout)
+        return (conn, False)
+
+    def _fail(self, errno, reason):
+        """Return a failed 'results' NaElement, as NaServer does."""
+
+        out = NaElement('results')
+        out.attr_set('status', 'failed')
+        out.attr_set('reason', reason)
+        out.attr_set('errno', str(errno))
+        return out
+
+    def _is_alive(self, conn):
+        """
+        Check that an idle connection has not been closed by the filer.
+
+        An idle keep-alive socket should have nothing to read; if it is
+        readable, the filer has closed (or broken) the connection.
+        """
+
+        if conn.sock is None:
+            return False
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def _parse(self, body):
+        """Parse a ZAPI response into an NaElement; return 'results'."""
+
+        if self.fast_xml:
+            results = ZapiElement.parse(body).child_get('results')
+            if results is None:
+                return self._fail(13001, 'No results element in output!')
+            return results
+
+        stack = []
+        root = []
+
+        def start(name, attrs):
+            nae = NaElement(name)
+            for key, value in attrs.items():
+                nae.attr_set(key, value)
+            if stack:
+                stack[-1].child_add(nae)
+            else:
+                root.append(nae)
+            stack.append(nae)
+
+        def end(name):
+            stack.pop()
+
+        def data(content):
+            if stack:
+                stack[-1].add_content(content)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+        parser.Parse(body, True)
+
+        results = root[0].child_get('results')
+        if results is None:
+            return self._fail(13001, 'No results element in output!')
+        return results
+
+    def _post(self, request):
+        """
+        POST request on a pooled connection; return (status, body).
+
+        If a reused connection turns out to have been closed by the
+        filer before the request reached it, the request is retried on
+        another.  Once the filer may have acted on the request (e.g. on
+        a timeout, or after a response began), it is never resent, as
+        many APIs are not idempotent.
+        """
+
+        headers = {'Content-Type': 'text/xml; charset="UTF-8"',
+                   'Authorization': self.auth,
+                   'Connection': 'keep-alive'}
+
+        while True:
+            conn, reused = self._checkout()
+            response = None
+            try:
+                conn.request('POST', self.url, request, headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if not reused or response is not None or not self._stale(e):
+                    raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(conn)
+        return (response.status, body)
+
+    def _stale(self, e):
+        """
+        Return True if exception e shows that a reused connection had
+        been closed by the filer, without any response to the request.
+        """
+
+        if isinstance(e, socket.timeout):
+            return False
+        if isinstance(e, httplib.BadStatusLine):
+            return e.line == repr('')
+        if isinstance(e, socket.error):
+            return e.errno in (ECONNABORTED, ECONNRESET, EPIPE)
+        return False
+
+
+class MetadataCache:
+    """
+    An on-disk store of filer metadata that rarely changes.
+
+    Perf counter descriptions are stored in an sqlite database at
+    'path', keyed by filer hostname, ONTAP version and object name.
+    When a filer reports a different version than the one its entries
+    were stored under, all of that filer's entries are discarded.
+
+    Each filer's ONTAP version is also stored, and is trusted for
+    'version_ttl' seconds; an upgrade within that time goes unnoticed.
+    """
+
+    def __init__(self, path, version_ttl=86400):
+        self.path = path
+        self.version_ttl = version_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS perf_object_info (
+                           hostname TEXT, version TEXT, objectname TEXT,
+                           info TEXT, PRIMARY KEY (hostname, objectname))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS version (
+                           hostname TEXT PRIMARY KEY, version TEXT,
+                           updated REAL)""")
+        self.db.commit()
+
+    def get_perf_object_info(self, hostname, version, objectname):
+        """Return cached counter info for objectname, or None."""
+
+        with self.lock:
+            row = self.db.execute("""SELECT version, info
+                                     FROM perf_object_info
+                                     WHERE hostname = ? AND objectname = ?""",
+                                  (hostname, objectname)).fetchone()
+            if row is None:
+                return None
+            if row[0] != version:
+                self.db.execute("""DELETE FROM perf_object_info
+                                   WHERE hostname = ? AND version != ?""",
+                                (hostname, version))
+                self.db.commit()
+                return None
+
+        return json.loads(row[1])
+
+    def get_version(self, hostname):
+        """Return the stored ONTAP version of hostname, or None if stale."""
+
+        with self.lock:
+            row = self.db.execute("""SELECT version, updated FROM version
+                                     WHERE hostname = ?""",
+                                  (hostname,)).fetchone()
+        if row is None or time.time() - row[1] > self.version_ttl:
+            return None
+        return row[0]
+
+    def set_perf_object_info(self, hostname, version, objectname, info):
+        """Store counter info for objectname."""
+
+        with self.lock:
+            self.db.execute("""INSERT OR REPLACE INTO perf_object_info
+                               VALUES (?, ?, ?, ?)""",
+                            (hostname, version, objectname, json.dumps(info)))
+            self.db.commit()
+
+    def set_version(self, hostname, version):
+        """Store the ONTAP version of hostname."""
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO version VALUES (?, ?, ?)",
+                            (hostname, version, time.time()))
+            self.db.commit()
+
+
+class PerfRecorder:
+    """
+    Keep a rolling history of cooked perf counters from a PerfSampler.
+
+    Each counter of each instance is stored in a RingBuffer of 'size'
+    samples, reachable as self.history[instance][counter].  Array
+    counters are stored as 2-D buffers with one column per label.
+    String counters are not recorded.
+    """
+
+    def __init__(self, sampler, size=360):
+        self.sampler = sampler
+        self.size = size
+        self.history = {}
+        self.timestamps = RingBuffer(size)
+
+    def avg(self, instance, counter, n=None):
+        """Return the mean of the last n samples of a counter."""
+
+        return self._labelled(counter, self.history[instance][counter].avg(n))
+
+    def last(self, instance, counter, n=None):
+        """Return the last n samples of a counter, oldest first."""
+
+        return self.history[instance][counter].last(n)
+
+    def max(self, instance, counter, n=None):
+        """Return the largest of the last n samples of a counter."""
+
+        return self._labelled(counter, self.history[instance][counter].max(n))
+
+    def min(self, instance, counter, n=None):
+        """Return the smallest of the last n samples of a counter."""
+
+        return self._labelled(counter, self.history[instance][counter].min(n))
+
+    def record(self):
+        """
+        Poll the sampler once and append its values to the history.
+
+        Return the cooked values, or None if this was the first poll.
+        Counters missing from a poll are recorded as NaN so that every
+        buffer stays aligned with self.timestamps.
+        """
+
+        cooked = self.sampler.poll()
+        if cooked is None:
+            return None
+
+        self.timestamps.append(self.sampler.last[0])
+
+        for inst in cooked:
+            if inst not in self.history:
+                self.history[inst] = {}
+            for name, value in cooked[inst].items():
+                if name in self.history[inst] or isinstance(value,
+                                                            basestring):
+                    continue
+                labels = self.sampler.info.get(name, {}).get('labels')
+                if isinstance(value, dict):
+                    buf = RingBuffer(self.size, len(labels))
+                else:
+                    buf = RingBuffer(self.size)
+                # Counters first seen mid-run are NaN for earlier polls:
+                for i in range(len(self.timestamps) - 1):
+                    buf.append(None)
+                self.history[inst][name] = buf
+
+        for inst, counters in self.history.items():
+            values = cooked.get(inst, {})
+            for name, buf in counters.items():
+                value = values.get(name)
+                if isinstance(value, dict):
+                    labels = self.sampler.info[name]['labels']
+                    value = [value.get(l) for l in labels]
+                buf.append(value)
+
+        return cooked
+
+    def run(self, interval, count=None):
+        """
+        Record every 'interval' seconds, 'count' times or forever.
+        """
+
+        i = 0
+        while count is None or i < count:
+            start = time.time()
+            self.record()
+            i = i + 1
+            time.sleep(max(0, interval - (time.time() - start)))
+
+    def _labelled(self, counter, value):
+        """Turn a per-column list from a 2-D buffer into a label dict."""
+
+        if isinstance(value, list):
+            return dict(zip(self.sampler.info[counter]['labels'], value))
+        return value
+
+
+class PerfSampler:
+    """
+    Cook raw perf counters from a Filer into ONTAP-defined values.
+
+    Counters are interpreted according to the 'properties' and
+    'base-counter' reported by Filer.get_perf_object_info:
+
+    raw - the current value
+    delta - difference between two samples
+    rate - delta divided by the seconds between two samples
+    average - delta divided by the delta of the base counter
+    percent - 100 times delta divided by the delta of the base counter
+    string, text - the current value
+
+    Array counters are cooked label by label.  Counters that went
+    backwards between samples (e.g. after a reboot) are reported as None.
+    """
+
+    def __init__(self, filer, objectname, read=[], instances=[]):
+        self.filer = filer
+        self.objectname = objectname
+        self.instances = instances
+        self.info = filer.get_perf_object_info(objectname)
+
+        # Base counters must be read alongside the counters using them:
+        self.read = list(read)
+        for name in read:
+            base = self.info[name].get('base-counter')
+            if base and base not in self.read:
+                self.read.append(base)
+
+        self.last = None
+
+    def compute(self, prev, cur):
+        """
+        Return a dict tree of cooked values between samples prev and cur.
+
+        prev and cur are (timestamp, data) tuples as returned by sample().
+        Only instances present in both samples are reported.
+        """
+
+        elapsed = cur[0] - prev[0]
+        prev_data = prev[1]
+        cur_data = cur[1]
+
+        inst_names = [i for i in cur_data if i in prev_data]
+        cooked = dict([(i, {}) for i in inst_names])
+
+        # Decide how to treat each counter once, then apply across all
+        # instances:
+        for name, kind, base in self._counter_plan(cur_data, inst_names):
+            for i in inst_names:
+                c = cur_data[i]
+                p = prev_data[i]
+                if name not in c or name not in p:
+                    continue
+                if kind == 'raw':
+                    cooked[i][name] = c[name]
+                elif kind in ('delta', 'rate'):
+                    if kind == 'rate':
+                        scale = elapsed
+                    else:
+                        scale = 1
+                    cooked[i][name] = self._cook(c[name], p[name], scale)
+                else:
+                    if base not in c or base not in p:
+                        continue
+                    cooked[i][name] = self._cook(c[name], p[name],
+                                                 (c[base], p[base]),
+                                                 kind == 'percent')
+
+        return cooked
+
+    def poll(self):
+        """
+        Take a sample; return values cooked against the previous sample.
+
+        Returns None on the first call, as there is nothing to compare to.
+        """
+
+        cur = self.sample()
+        prev = self.last
+        self.last = cur
+        if prev is None:
+            return None
+        return self.compute(prev, cur)
+
+    def sample(self):
+        """Return a (timestamp, data) tuple of raw counter values."""
+
+        now = time.time()
+        data = self.filer.get_perf_object(self.objectname, self.read,
+                                          self.instances)
+        return (now, data)
+
+    def _cook(self, cur, prev, scale, percent=False):
+        """
+        Return (cur - prev) / scale, element-wise for array counters.
+
+        scale is either a number or a (cur, prev) tuple of base counter
+        values, whose difference is used as the divisor.
+        """
+
+        if isinstance(cur, dict):
+            cooked = {}
+            for label in cur:
+                if isinstance(scale, tuple) and isinstance(scale[0], dict):
+                    label_scale = (scale[0].get(label, 0),
+                                   scale[1].get(label, 0))
+                else:
+                    label_scale = scale
+                cooked[label] = self._cook(cur[label], prev.get(label, 0),
+                                           label_scale, percent)
+            return cooked
+
+        delta = cur - prev
+        if isinstance(scale, tuple):
+            scale = scale[0] - scale[1]
+        if delta < 0 or scale < 0:
+            return None
+        if scale == 0:
+            return 0
+
+        if percent:
+            return 100.0 * delta / scale
+        else:
+            return float(delta) / scale
+
+    def _counter_plan(self, data, inst_names):
+        """Return a list of (counter, kind, base counter) tuples for data."""
+
+        names = {}
+        for i in inst_names:
+            for name in data[i]:
+                names[name] = True
+
+        plan = []
+        for name in sorted(names):
+            info = self.info.get(name, {})
+            props = info.get('properties', 'raw').split(',')
+            base = info.get('base-counter')
+            kind = 'raw'
+            for k in ('percent', 'average', 'rate', 'delta'):
+                if k in props:
+                    kind = k
+                    break
+            if kind in ('percent', 'average') and not base:
+                kind = 'raw'
+            plan.append((name, kind, base))
+
+        return plan
+
+
+class RecordingTransport(KeepAliveTransport):
+    """
+    A KeepAliveTransport that logs every request and response.
+
+    Each exchange is appended to the file at 'path' as one line of
+    JSON: the request XML, the response XML (zlib-compressed, in
+    base64), the HTTP status and the seconds taken.  Each line is
+    flushed as it is written, so the log of a session that crashes or
+    is killed is still usable; replay it without a filer using
+    ReplayTransport.  Other arguments are as for KeepAliveTransport.
+    """
+
+    def __init__(self, hostname, user, passwd, path, **kwargs):
+        KeepAliveTransport.__init__(self, hostname, user, passwd, **kwargs)
+        self.path = path
+        self.log = open(path, 'ab')
+        self.log_lock = threading.Lock()
+
+    def close(self):
+        """Close all idle connections and the log."""
+
+        KeepAliveTransport.close(self)
+        with self.log_lock:
+            if not self.log.closed:
+                self.log.close()
+
+    def _post(self, request):
+        start = time.time()
+        status, body = KeepAliveTransport._post(self, request)
+        line = json.dumps({'request': request,
+                           'status': status,
+                           'response': base64.b64encode(zlib.compress(body)),
+                           'seconds': time.time() - start},
+                          separators=(',', ':'))
+        with self.log_lock:
+            if not self.log.closed:
+                self.log.write(line + '\n')
+                self.log.flush()
+        return (status, body)
+
+
+class ReplayTransport(KeepAliveTransport):
+    """
+    Answer requests from a log written by RecordingTransport.
+
+    No filer is contacted: each request is answered with the response
+    recorded for an identical request, so a session's parsing and
+    object-building costs can be profiled offline at full speed.  A
+    request made several times gets its recorded responses in order;
+    once they run out, the last is repeated.  A request absent from
+    the log fails with errno 13001.  An incomplete last line, as left
+    by a recording that was killed mid-write, is ignored.
+    """
+
+    def __init__(self, path, fast_xml=False):
+        KeepAliveTransport.__init__(self, 'replay', '', '',
+                                    transport_type='HTTP', fast_xml=fast_xml)
+        self.path = path
+        self.responses = {}
+        self.replayed = 0
+        self.missed = 0
+
+        log = open(path, 'rb')
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            request = entry['request'].encode('utf-8')
+            response = (entry['status'],
+                        zlib.decompress(base64.b64decode(entry['response'])))
+            self.responses.setdefault(request, []).append(response)
+        log.close()
+
+    def _post(self, request):
+        with self.lock:
+            responses = self.responses.get(request)
+            if not responses:
+                self.missed = self.missed + 1
+                raise httplib.HTTPException('No recorded response for '
+                                            'request')
+            self.replayed = self.replayed + 1
+            if len(responses) > 1:
+                return responses.pop(0)
+            return responses[0]
+
+
+class ResponseCache:
+    """
+    An LRU cache of read-only API responses, shared by Filers.
+
+    Responses are kept for 'ttl' seconds, or for the number of seconds
+    given for the API's name in the 'ttls' dict; a TTL of 0 disables
+    caching for that API.  At most 'maxsize' responses are kept.
+
+    Calls are keyed by (filer hostname, API name, arguments...) tuples.
+    Any other (i.e. mutating) call discards the same filer's cached
+    responses of the same API family (e.g. 'volume' for 'volume-size')
+    that mention the same object, as well as that family's filer-wide
+    listings.
+    """
+
+    def __init__(self, ttl=30, maxsize=1000, ttls={}):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.ttls = ttls
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Discard all cached responses."""
+
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        """Return the cached response for key, or None."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if time.time() > entry[0]:
+                return None
+            # Re-insert as most recently used:
+            self.entries[key] = entry
+            return entry[1]
+
+    def invalidate(self, key):
+        """Discard responses related to the mutating call described by key."""
+
+        family = self._family(key)
+        objects = self._objects(key)
+        with self.lock:
+            for k in list(self.entries):
+                if k[0] != key[0] or self._family(k) != family:
+                    continue
+                k_objects = self._objects(k)
+                if not objects or not k_objects or objects & k_objects:
+                    del self.entries[k]
+
+    def is_read(self, key):
+        """Return True if the call described by key has no side effects."""
+
+        api = key[1]
+        if api == 'system-cli':
+            return (key[2:4] == ('cifs', 'shares') and
+                    not [a for a in key[4:] if a.startswith('-')])
+        if api == 'volume-size':
+            return 'new-size' not in key[2::2]
+        if api.startswith('perf-object-get-instances'):
+            return False
+        return re.search(r'(^|-)(get|list|status)(-|$)', api) is not None
+
+    def update(self, key, out):
+        """Store or invalidate following a call described by key."""
+
+        if not self.is_read(key):
+            self.invalidate(key)
+            return
+
+        ttl = self.ttls.get(key[1], self.ttl)
+        if not ttl or out.results_status() == 'failed':
+            return
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, out)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def _family(self, key):
+        """Return the API family ('volume', 'cifs', ...) of a call."""
+
+        if key[1] == 'system-cli':
+            return key[2]
+        if re.match(r'^snapvault-.*-snapshot-create$', key[1]):
+            # These create snapshots, so invalidate snapshot listings:
+            return 'snapshot'
+        return key[1].split('-')[0]
+
+    def _objects(self, key):
+        """Return the set of object names a call refers to."""
+
+        if key[1] == 'system-cli':
+            values = key[4:]
+        else:
+            values = key[3::2]
+
+        objects = set()
+        for v in values:
+            objects.add(v)
+            objects.add(re.sub(r'^/vol/', '', v))
+        return objects
+
+
+class RetentionRule:
+    """
+    Which snapshots of matching volumes to keep.
+
+    pattern - regular expression matched against the start of snapshot
+              names; the rule governs the snapshots it matches
+    keep_last - number of the newest governed snapshots always kept
+    max_age - governed snapshots older than this many seconds are
+              deleted, beyond the keep_last newest
+    volumes - optional regular expression matched against the start of
+              volume names; by default the rule applies to all volumes
+
+    If max_age is None, every governed snapshot beyond the keep_last
+    newest is deleted; if keep_last is also None, none is.
+    """
+
+    def __init__(self, pattern, keep_last=None, max_age=None, volumes=None):
+        self.pattern = re.compile(pattern)
+        self.keep_last = keep_last
+        self.max_age = max_age
+        if volumes is not None:
+            volumes = re.compile(volumes)
+        self.volumes = volumes
+
+    def applies_to(self, volume):
+        """Return True if the rule applies to volume name."""
+
+        return self.volumes is None or bool(self.volumes.match(volume))
+
+    def expired(self, snapshots, now):
+        """
+        Return the snapshots (dicts, newest first) that the rule deletes.
+
+        snapshots are the rule's governed snapshots, newest first.
+        """
+
+        if self.keep_last is None and self.max_age is None:
+            return []
+
+        expired = []
+        for i, snapshot in enumerate(snapshots):
+            if self.keep_last is not None and i < self.keep_last:
+                continue
+            if (self.max_age is not None and
+                now - snapshot['access-time'] <= self.max_age):
+                continue
+            expired.append(snapshot)
+        return expired
+
+
+class RingBuffer:
+    """
+    A fixed-size circular buffer of floats backed by array('d').
+
+    With 'width' set, each entry is a row of that many values, stored
+    contiguously.  Missing values (None) are stored as NaN and ignored
+    by min(), max() and avg().
+    """
+
+    def __init__(self, size, width=None):
+        self.size = size
+        self.width = width
+        self.count = 0
+        self.pos = 0
+        self.data = array('d', [NAN]) * (size * (width or 1))
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        """Add value (a number, or a list of width numbers) in O(1)."""
+
+        if self.width is None:
+            if value is None:
+                value = NAN
+            self.data[self.pos] = value
+        else:
+            if value is None:
+                value = [None] * self.width
+            start = self.pos * self.width
+            for j in range(self.width):
+                v = value[j]
+                if v is None:
+                    v = NAN
+                self.data[start + j] = v
+
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count = self.count + 1
+
+    def avg(self, n=None):
+        """Return the mean of the last n entries (all if n is None)."""
+
+        return self._reduce(n, lambda vals: sum(vals) / len(vals))
+
+    def last(self, n=None):
+        """Return the last n entries (all if n is None), oldest first."""
+
+        if n is None or n > self.count:
+            n = self.count
+        w = self.width or 1
+        first = (self.pos - n) % self.size
+        if first + n <= self.size:
+            flat = self.data[first * w:(first + n) * w]
+        else:
+            flat = self.data[first * w:] + self.data[:self.pos * w]
+
+        if self.width is None:
+            return flat.tolist()
+        return [flat[i * w:(i + 1) * w].tolist() for i in range(n)]
+
+    def max(self, n=None):
+        """Return the largest of the last n entries (all if n is None)."""
+
+        return self._reduce(n, max)
+
+    def min(self, n=None):
+        """Return the smallest of the last n entries (all if n is None)."""
+
+        return self._reduce(n, min)
+
+    def _reduce(self, n, func):
+        """Apply func to the non-NaN values in the window, per column."""
+
+        window = self.last(n)
+        if self.width is None:
+            columns = [window]
+        else:
+            columns = zip(*window) or [[]] * self.width
+
+        result = []
+        for column in columns:
+            vals = [v for v in column if v == v]
+            if vals:
+                result.append(func(vals))
+            else:
+                result.append(None)
+
+        if self.width is None:
+            return result[0]
+        return result
+
+
 class Share:
     """A CIFS share on a NetApp filer."""
 
@@ -1224,11 +3758,10 @@ class Share:
         Return boolean.
         """
 
-        output = self._get_cifs_share()
-        if re.match('^No share is matching that name\.', output):
-            return False
-        else:
+        if self._get_share():
             return True
+        else:
+            return False
 
     def create(self, mount_point, description=False, forcegroup=False,
                dir_umask=False, file_umask=False, umask=False):
@@ -1252,28 +3785,19 @@ class Share:
             command.append(umask)
 
         self.filer.invoke_cli(*command)
+        self.filer._forget_share(self.name, listing=True)
 
     def del_access(self, user):
         """CLI equivalent to 'cifs access -delete self.name <user>'."""
 
         out = self.filer.invoke_cli('cifs', 'access', '-delete', self.name,
                                     user)
+        self.filer._forget_share(self.name)
 
     def get_access(self):
         """Return a dict containing the ACLs for a share."""
 
-        output = self._get_cifs_share()
-        acl_lines = output.splitlines()[1:]
-
-        acls = {}
-        for line in acl_lines:
-            if re.match(r'^\s+\.\.\.', line):
-                continue # It's an option line, not an ACL line
-            m = re.match(r'^\s+(.*) / (Full Control|Change|Read)$', line)
-            if m:
-                acls[m.groups()[0]] = m.groups()[1]
-
-        return acls
+        return dict(self._get_share()['access'])
 
     def get_description(self):
         """
@@ -1282,12 +3806,7 @@ class Share:
         If the description is not set, return False.
         """
 
-        config = self._get_cifs_share().splitlines()[0]
-        m = re.match(r'^(.*\S)\s+(/\S*)\s+(.*)$', config)
-        if m:
-            return m.groups()[2]
-        else:
-            return False
+        return self._get_share()['description']
 
     def get_dir_umask(self):
         """
@@ -1296,8 +3815,7 @@ class Share:
         If 'dir_umask' is not set, return False.
         """
 
-        pattern = re.compile(r'^\s+\.\.\. dir_umask=(.*)$')
-        return self._get_option(pattern)
+        return self._get_share()['dir_umask']
 
     def get_file_umask(self):
         """
@@ -1306,8 +3824,7 @@ class Share:
         If 'file_umask' is not set, return False.
         """
 
-        pattern = re.compile(r'^\s+\.\.\. file_umask=(.*)$')
-        return self._get_option(pattern)
+        return self._get_share()['file_umask']
 
     def get_forcegroup(self):
         """
@@ -1316,15 +3833,12 @@ class Share:
         If 'forcegroup' is not set, return False.
         """
 
-        pattern = re.compile(r'^\s+\.\.\. forcegroup=(.*)$')
-        return self._get_option(pattern)
+        return self._get_share()['forcegroup']
 
     def get_mount_point(self):
         """Return a share's mount point."""
 
-        config = self._get_cifs_share().splitlines()[0]
-        m = re.match(r'^(.*\S)\s+(/\S*)\s+(.*)$', config)
-        return m.groups()[1]
+        return self._get_share()['mount-point']
 
     def get_umask(self):
         """
@@ -1333,8 +3847,7 @@ class Share:
         If 'umask' is not set, return False.
         """
 
-        pattern = re.compile(r'^\s+\.\.\. umask=(.*)$')
-        return self._get_option(pattern)
+        return self._get_share()['umask']
 
     def modify(self, description=False, forcegroup=False, dir_umask=False,
                file_umask=False, umask=False):
@@ -1359,37 +3872,411 @@ class Share:
             command.append(umask)
 
         self.filer.invoke_cli(*command)
+        self.filer._forget_share(self.name)
 
     def set_access(self, user, rights):
         """CLI equivalent to 'cifs access share <user> <rights>'."""
 
         out = self.filer.invoke_cli('cifs', 'access', self.name, user, rights)
+        self.filer._forget_share(self.name)
 
-    def _get_cifs_share(self):
+    def _get_share(self):
         """
-        Return the raw CLI output from 'cifs shares <self.name>'.
+        Return a dict of the share's configuration, or None if not found.
 
-        The first two header lines are stripped.
+        The dict is as described in Filer.get_share_table.
         """
-        
-        out = self.filer.invoke_cli('cifs', 'shares', self.name)
 
-        output = out.child_get('cli-output').element['content'].splitlines()
+        return self.filer._get_share(self.name)
+
+
+class SnapshotCatalog:
+    """
+    The snapshots of one volume, indexed by name and by creation time.
+
+    Each snapshot is a dict of snapshot-info fields: name, access-time
+    (creation time, in seconds since the epoch), busy, dependency, and
+    total and cumulative-total (in KB).  Lookups by name take constant
+    time; newest() and since() use a list kept sorted by creation time.
+    """
 
-        return '\n'.join(output[2:])
+    def __init__(self, snapshots=[]):
+        self.by_name = {}
+        self.by_time = []
+        self.lock = threading.Lock()
 
-    def _get_option(self, pattern):
+        for info in snapshots:
+            self.by_name[info['name']] = info
+        self.by_time = sorted([(info['access-time'], info['name'])
+                               for info in self.by_name.values()])
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def add(self, info):
+        """Add (or replace) the snapshot described by info."""
+
+        with self.lock:
+            self._unindex(info['name'])
+            self.by_name[info['name']] = info
+            bisect.insort(self.by_time, (info['access-time'], info['name']))
+
+    def get(self, name):
+        """Return snapshot name's dict, or None."""
+
+        return self.by_name.get(name)
+
+    def newest(self, pattern=None):
+        """
+        Return the newest snapshot whose name matches regular expression
+        pattern (from its start), or the newest of all if pattern is None.
+        Return None if there is no such snapshot.
         """
-        Search the _get_cifs_share output for a CIFS option and return it.
 
-        If option is not set, return False.
+        if pattern is not None:
+            pattern = re.compile(pattern)
+
+        with self.lock:
+            for access_time, name in reversed(self.by_time):
+                if pattern is None or pattern.match(name):
+                    return self.by_name[name]
+        return None
+
+    def remove(self, name):
+        """Remove snapshot name, if present."""
+
+        with self.lock:
+            self._unindex(name)
+
+    def rename(self, current_name, new_name):
+        """Rename snapshot current_name to new_name, if present."""
+
+        with self.lock:
+            info = self.by_name.get(current_name)
+            if info is None:
+                return
+            self._unindex(current_name)
+            info = dict(info, name=new_name)
+            self.by_name[new_name] = info
+            bisect.insort(self.by_time, (info['access-time'], new_name))
+
+    def since(self, timestamp=0):
+        """Return snapshots created at or after timestamp, oldest first."""
+
+        with self.lock:
+            i = bisect.bisect_left(self.by_time, (timestamp,))
+            return [self.by_name[name] for t, name in self.by_time[i:]]
+
+    def _unindex(self, name):
+        """Drop snapshot name from both indexes; the caller holds lock."""
+
+        info = self.by_name.pop(name, None)
+        if info is None:
+            return
+        key = (info['access-time'], name)
+        i = bisect.bisect_left(self.by_time, key)
+        if i < len(self.by_time) and self.by_time[i] == key:
+            del self.by_time[i]
+
+
+class SnapshotPruner:
+    """
+    Delete expired snapshots across the filers of a FilerPool.
+
+    Each snapshot is governed by the first of 'rules' (RetentionRules)
+    that applies to its volume and matches its name; snapshots matched
+    by no rule are kept.  The whole deletion plan is computed before
+    anything is deleted.  Volumes are pruned concurrently, within the
+    pool's per-filer limit, but each volume's snapshots are deleted one
+    after another, as 7-mode refuses a snapshot operation while another
+    is running on the volume.  Busy snapshots are skipped.
+    """
+
+    def __init__(self, pool, rules):
+        self.pool = pool
+        self.rules = rules
+        self.errors = {}
+        self.volume_errors = {}
+
+    def plan(self, now=None):
+        """
+        Return a list of the snapshots to delete, oldest first.
+
+        Each entry is a dict with 'filer', 'volume', 'snapshot',
+        'access-time', 'total' and 'busy' keys.  Snapshot catalogs are
+        loaded concurrently for every online volume of every filer in
+        the pool.  Filers whose volumes could not be listed are left
+        out, and their exceptions stored in self.errors, keyed by filer
+        name; volumes whose snapshots could not be listed are left out,
+        and their exceptions stored in self.volume_errors, keyed by
+        (filer name, volume name).
         """
 
-        output = self._get_cifs_share()
-        option_lines = output.splitlines()[1:]
+        if now is None:
+            now = time.time()
+
+        self.errors = {}
+        self.volume_errors = {}
+        names = sorted(self.pool.filers)
+        loaded = self.pool.run([(name, self._load) for name in names])
+
+        plan = []
+        for name, result in zip(names, loaded):
+            try:
+                volumes, errors = result.get()
+            except Exception as e:
+                self.errors[name] = e
+                continue
+            for volume, e in errors.items():
+                self.volume_errors[(name, volume)] = e
+            for volume in sorted(volumes):
+                for snapshot in self._expired(volume, volumes[volume], now):
+                    plan.append({'filer': name,
+                                 'volume': volume,
+                                 'snapshot': snapshot['name'],
+                                 'access-time': snapshot['access-time'],
+                                 'total': snapshot['total'],
+                                 'busy': snapshot['busy']})
+
+        plan.sort(key=lambda entry: entry['access-time'])
+        return plan
+
+    def prune(self, dry_run=False, now=None):
+        """
+        Delete the snapshots in plan(); return the plan.
 
-        for line in option_lines:
-            m = pattern.match(line)
-            if m:
-                return m.groups()[0]
-        return False
+        Each entry gains a 'result' key: 'deleted', 'busy' (skipped),
+        'dry-run' (if dry_run is True, nothing is deleted) or 'failed',
+        in which case 'error' holds the exception raised.
+        """
+
+        plan = self.plan(now)
+
+        volumes = collections.OrderedDict()
+        for entry in plan:
+            entry['error'] = None
+            if entry['busy']:
+                entry['result'] = 'busy'
+            elif dry_run:
+                entry['result'] = 'dry-run'
+            else:
+                volumes.setdefault((entry['filer'], entry['volume']),
+                                   []).append(entry)
+
+        self.pool.run([(filer, self._delete, (volume, entries))
+                       for (filer, volume), entries in volumes.items()])
+
+        return plan
+
+    def _delete(self, filer, volume, entries):
+        """
+        Delete the snapshots of volume on filer in entries, one at a time,
+        recording each one's result in its entry.
+        """
+
+        v = FlexVol(filer, volume)
+        for entry in entries:
+            try:
+                v.snapshot_delete(entry['snapshot'])
+                entry['result'] = 'deleted'
+            except Exception as e:
+                entry['result'] = 'failed'
+                entry['error'] = e
+
+    def _expired(self, volume, catalog, now):
+        """Return the snapshots of volume's catalog that rules delete."""
+
+        rules = [rule for rule in self.rules if rule.applies_to(volume)]
+        governed = [[] for rule in rules]
+        for snapshot in reversed(catalog.since()):
+            for i, rule in enumerate(rules):
+                if rule.pattern.match(snapshot['name']):
+                    governed[i].append(snapshot)
+                    break
+
+        expired = []
+        for rule, snapshots in zip(rules, governed):
+            expired.extend(rule.expired(snapshots, now))
+        return expired
+
+    def _load(self, filer):
+        """
+        Return a tuple of dicts, keyed by volume name, of the
+        SnapshotCatalogs of filer's online volumes and of the exceptions
+        raised by those that could not be listed.
+        """
+
+        volumes = sorted([name for name, info
+                          in filer.get_volume_inventory().items()
+                          if info.get('state') == 'online'])
+        results = _parallel_map(filer._get_snapshot_catalog, volumes,
+                                self.pool.per_filer_limit)
+
+        catalogs = {}
+        errors = {}
+        for name, (catalog, error) in zip(volumes, results):
+            if error:
+                errors[name] = error
+            else:
+                catalogs[name] = catalog
+        return (catalogs, errors)
+
+
+class ZapiElement(object):
+    """
+    A lightweight, read-mostly stand-in for NaElement.
+
+    ZapiElements are built by ZapiElement.parse straight from expat
+    events, use __slots__, and look children up by name through an
+    index built on first use, instead of scanning.  They provide the
+    NaElement accessors this module uses, including the 'element' dict.
+    """
+
+    __slots__ = ('name', 'content', 'children', 'attrs', '_index')
+
+    def __init__(self, name, content='', attrs=None):
+        self.name = name
+        self.content = content
+        self.children = []
+        self.attrs = attrs
+        self._index = None
+
+    @classmethod
+    def parse(cls, body):
+        """Parse XML text into a tree of ZapiElements; return the root."""
+
+        top = cls(None)
+        stack = [top]
+        text = [[]]
+
+        def start(name, attrs):
+            node = cls(name, attrs=attrs or None)
+            stack[-1].children.append(node)
+            stack.append(node)
+            text.append([])
+
+        def end(name):
+            stack.pop().content = ''.join(text.pop())
+
+        def data(content):
+            text[-1].append(content)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.returns_unicode = False
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+        parser.Parse(body, True)
+
+        return top.children[0]
+
+    @property
+    def element(self):
+        return {'name': self.name,
+                'content': self.content,
+                'children': self.children,
+                'attrs': self.attrs or {}}
+
+    def attr_get(self, key):
+        if self.attrs:
+            return self.attrs.get(key)
+        return None
+
+    def attr_set(self, key, value):
+        if self.attrs is None:
+            self.attrs = {}
+        self.attrs[key] = value
+
+    def child_add(self, child):
+        self.children.append(child)
+        self._index = None
+
+    def child_get(self, name):
+        """Return the first child called name, or None."""
+
+        if self._index is None:
+            index = {}
+            for child in reversed(self.children):
+                index[child.name] = child
+            self._index = index
+        return self._index.get(name)
+
+    def child_get_int(self, name):
+        return int(self.child_get_string(name))
+
+    def child_get_string(self, name):
+        child = self.child_get(name)
+        if child is None:
+            return None
+        return child.content
+
+    def children_get(self):
+        return self.children
+
+    def has_children(self):
+        return len(self.children) > 0
+
+    def results_errno(self):
+        return self.attr_get('errno')
+
+    def results_reason(self):
+        return self.attr_get('reason')
+
+    def results_status(self):
+        return self.attr_get('status')
+
+    def sprintf(self, indent=''):
+        """Return the element and its children as XML text."""
+
+        attrs = ''
+        if self.attrs:
+            attrs = ''.join([' %s="%s"' % (k, escape(v, {'"': '&quot;'}))
+                             for k, v in self.attrs.items()])
+        if not self.children:
+            return '%s<%s%s>%s</%s>\n' % (indent, self.name, attrs,
+                                          escape(self.content), self.name)
+        return '%s<%s%s>\n%s%s</%s>\n' % (
+            indent, self.name, attrs,
+            ''.join([c.sprintf(indent + '\t') for c in self.children]),
+            indent, self.name)
+
+
+def _parallel_map(func, items, max_workers):
+    """
+    Call func on each of items using up to max_workers threads.
+
+    Return a list of (result, exception) tuples in the order of items;
+    exactly one of each pair is None.
+    """
+
+    items = list(items)
+    results = [None] * len(items)
+    work = Queue.Queue()
+    for i in range(len(items)):
+        work.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (func(items[i]), None)
+            except Exception as e:
+                results[i] = (None, e)
+
+    threads = []
+    for n in range(max(1, min(max_workers, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    return results
@@ -0,0 +1,626 @@
+"""
+A stand-in for a Data ONTAP 7-mode filer's ZAPI interface.
+
+SyntheticFiler answers enough of the ZAPI XML protocol for this
+module's Filer to be exercised without a real filer: system-get-version,
+aggr-list-info, volume-list-info, volume-size, volume-autosize-get,
+snmp-get, the perf-object-* calls and iterators, nfs-exportfs-*,
+snapshot-* and system-cli for 'cifs shares'.  Its data set is
+synthetic, sized by the constructor's arguments, and every request can
+be delayed by 'latency' seconds.
+
+It can be served over HTTP by ZapiStubServer, for use with
+Ontap.KeepAliveTransport, or called in-process through StubTransport:
+
+    stub = OntapStub.SyntheticFiler(volumes=400, exports=1500)
+    filer = Ontap.Filer('stub', 'user', 'passwd',
+                        transport=OntapStub.StubTransport(stub))
+
+Run as a script, it serves a synthetic filer until interrupted.
+"""
+
+import argparse
+import BaseHTTPServer
+import re
+import SocketServer
+import threading
+import time
+
+from Ontap import KeepAliveTransport, ZapiElement
+
+
+class SyntheticFiler:
+    """A synthetic filer's data set and ZAPI request handler."""
+
+    def __init__(self, volumes=10, exports=10, shares=10, perf_instances=10,
+                 snapshots=10, aggrs=2, latency=0,
+                 version='NetApp Release 7.3.6'):
+        self.latency = latency
+        self.version = version
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.calls = {}
+
+        self.aggrs = ['aggr%d' % i for i in range(aggrs)]
+
+        self.volumes = {}
+        for i in range(volumes):
+            name = 'vol%d' % i
+            size_kb = (i % 10 + 1) * 100 * 1024 * 1024
+            self.volumes[name] = {
+                'size-kb': size_kb,
+                'used-percent': (i * 37) % 100,
+                'snapshot-percent-reserved': 20,
+                'autosize-enabled': i % 2 == 0,
+                'increment-size': 10 * 1024 * 1024,
+                'maximum-size': size_kb * 2,
+                'aggr': 'aggr%d' % (i % max(aggrs, 1)),
+                'snapshots': {}}
+            for j in range(snapshots):
+                self.volumes[name]['snapshots']['nightly.%d' % j] = {
+                    'access-time': int(self.start) - j * 86400,
+                    'busy': j == 0,
+                    'total': (j + 1) * 1024}
+
+        self.exports = {}
+        for i in range(exports):
+            path = '/vol/vol%d' % (i % max(volumes, 1))
+            if i >= volumes:
+                path = '%s/qtree%d' % (path, i)
+            self.exports[path] = {'read-only': ['ro%d.example.com' % i],
+                                  'read-write': ['rw%d.example.com' % i],
+                                  'root': ['admin.example.com'],
+                                  'nosuid': i % 2 == 0,
+                                  'sec-flavor': 'sys'}
+
+        self.shares = {}
+        for i in range(shares):
+            self.shares['share%d' % i] = {
+                'mount-point': '/vol/vol%d' % (i % max(volumes, 1)),
+                'description': 'Synthetic share %d' % i,
+                'options': ['umask=022', 'forcegroup=staff'],
+                'access': {'everyone': 'Read',
+                           'DOMAIN\\admins': 'Full Control'}}
+
+        self.perf_counters = [
+            ('total_ops', 'rate', 'per_sec', None, None),
+            ('read_ops', 'rate', 'per_sec', None, None),
+            ('avg_latency', 'average', 'microsec', 'total_ops', None),
+            ('read_data', 'rate', 'b_per_sec', None, None),
+            ('read_latency_hist', 'delta', 'none', None,
+             ['0-1ms', '1-10ms', '10-100ms', '>100ms'])]
+        self.perf_instances = ['instance%d' % i
+                               for i in range(perf_instances)]
+        self.iterators = {}
+        self.next_tag = 1
+
+    def handle(self, body):
+        """Answer a ZAPI request body with a response body."""
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        request = ZapiElement.parse(body)
+        if request.children:
+            request = request.children[0]
+
+        with self.lock:
+            self.calls[request.name] = self.calls.get(request.name, 0) + 1
+            handler = getattr(self, '_api_' + request.name.replace('-', '_'),
+                              None)
+            if handler is None:
+                results = self._failed(13005, 'Unable to find API: %s' %
+                                       request.name)
+            else:
+                try:
+                    results = handler(request)
+                except StubError as e:
+                    results = self._failed(e.errno, e.reason)
+
+        if results.attr_get('status') is None:
+            results.attr_set('status', 'passed')
+        return ("<?xml version='1.0' encoding='UTF-8' ?>\n"
+                "<!DOCTYPE netapp SYSTEM 'file:/etc/netapp_filer.dtd'>\n"
+                "<netapp version='1.3' "
+                "xmlns='http://www.netapp.com/filer/admin'>\n" +
+                results.sprintf() + "</netapp>\n")
+
+    #
+    # API handlers; each returns a 'results' ZapiElement.
+    #
+
+    def _api_aggr_list_info(self, request):
+        name = request.child_get_string('aggregate')
+        if name is None:
+            names = self.aggrs
+        elif name in self.aggrs:
+            names = [name]
+        else:
+            raise StubError(13040, 'No aggregate named %s exists' % name)
+
+        results = ZapiElement('results')
+        aggregates = _add(results, 'aggregates')
+        for name in names:
+            vols = [vol for vol in self.volumes.values()
+                    if vol['aggr'] == name]
+            used = sum([vol['size-kb'] for vol in vols]) * 1024
+            total = used * 5 / 4 + 1024 ** 4
+            info = _add(aggregates, 'aggr-info')
+            _add(info, 'name', name)
+            _add(info, 'state', 'online')
+            space = _add(_add(_add(_add(info, 'aggregate-space-details'),
+                                   'aggregate-space-info'),
+                              'aggregate-space'),
+                         'fs-space-info')
+            for field, value in (
+                    ('fs-size-total', total),
+                    ('fs-size-used', used),
+                    ('fs-size-available', total - used),
+                    ('fs-percent-used-capacity', used * 100 / total),
+                    ('fs-files-total', 31876689),
+                    ('fs-files-used', 101),
+                    ('fs-percent-inode-used-capacity', 0),
+                    ('fs-maxfiles-available', 31876588),
+                    ('fs-maxfiles-used', 101),
+                    ('fs-maxfiles-possible', 2040109451),
+                    ('fs-files-private-used', 0),
+                    ('fs-inodefile-public-capacity', 31876689),
+                    ('fs-inodefile-private-capacity', 31876689),
+                    ('fs-sis-percent-saved', 0),
+                    ('fs-sis-shared-space', 0),
+                    ('fs-sis-saved-space', 0)):
+                _add(space, field, str(value))
+        return results
+
+    def _api_nfs_exportfs_append_rules(self, request):
+        for rule in request.child_get('rules').children:
+            self.exports[rule.child_get_string('pathname')] = \
+                self._read_rule(rule)
+        return ZapiElement('results')
+
+    def _api_nfs_exportfs_delete_rules(self, request):
+        for pathname in request.child_get('pathnames').children:
+            self.exports.pop(pathname.child_get_string('name'), None)
+        return ZapiElement('results')
+
+    def _api_nfs_exportfs_list_rules(self, request):
+        results = ZapiElement('results')
+        rules = _add(results, 'rules')
+        path = request.child_get_string('pathname')
+        if path is not None:
+            paths = [p for p in (path,) if p in self.exports]
+        else:
+            paths = sorted(self.exports)
+        for p in paths:
+            export = self.exports[p]
+            rule = _add(rules, 'exports-rule-info')
+            _add(rule, 'pathname', p)
+            _add(rule, 'nosuid', str(export['nosuid']).lower())
+            for hosts in ('read-only', 'read-write', 'root'):
+                if export[hosts]:
+                    host_list = _add(rule, hosts)
+                    for host in export[hosts]:
+                        _add(_add(host_list, 'exports-hostname-info'),
+                             'name', host)
+            _add(_add(_add(rule, 'sec-flavor'), 'sec-flavor-info'),
+                 'flavor', export['sec-flavor'])
+        return results
+
+    def _api_nfs_exportfs_modify_rule(self, request):
+        rule = request.child_get('rule').child_get('exports-rule-info')
+        path = rule.child_get_string('pathname')
+        if path not in self.exports:
+            raise StubError(13114, 'Export %s does not exist' % path)
+        self.exports[path] = self._read_rule(rule)
+        return ZapiElement('results')
+
+    def _api_perf_object_counter_list_info(self, request):
+        self._perf_object(request)
+        results = ZapiElement('results')
+        counters = _add(results, 'counters')
+        for name, props, unit, base, labels in self.perf_counters:
+            counter = _add(counters, 'counter-info')
+            _add(counter, 'name', name)
+            _add(counter, 'desc', 'Synthetic counter %s' % name)
+            _add(counter, 'privilege-level', 'basic')
+            _add(counter, 'properties', props)
+            _add(counter, 'unit', unit)
+            if base:
+                _add(counter, 'base-counter', base)
+            if labels:
+                _add(counter, 'type', 'array')
+                _add(_add(counter, 'labels'), 'label-info', ','.join(labels))
+        return results
+
+    def _api_perf_object_get_instances_iter_end(self, request):
+        self.iterators.pop(request.child_get_int('tag'), None)
+        return ZapiElement('results')
+
+    def _api_perf_object_get_instances_iter_next(self, request):
+        tag = request.child_get_int('tag')
+        if tag not in self.iterators:
+            raise StubError(13001, 'Invalid tag %d' % tag)
+        pending, counters = self.iterators[tag]
+        maximum = request.child_get_int('maximum')
+        batch = pending[:maximum]
+        del pending[:maximum]
+
+        results = ZapiElement('results')
+        _add(results, 'generation', '0')
+        _add(results, 'records', str(len(batch)))
+        instances = _add(results, 'instances')
+        elapsed = time.time() - self.start
+        for i, name in batch:
+            inst = _add(instances, 'instance-data')
+            _add(inst, 'name', name)
+            data = _add(inst, 'counters')
+            for c, props, unit, base, labels in self.perf_counters:
+                if counters and c not in counters:
+                    continue
+                rate = (i + 1) * 10
+                if labels:
+                    value = ','.join([str(int(elapsed * rate / (j + 1)))
+                                      for j in range(len(labels))])
+                elif props == 'average':
+                    value = str(int(elapsed * rate * 250))
+                else:
+                    value = str(int(elapsed * rate))
+                counter = _add(data, 'counter-data')
+                _add(counter, 'name', c)
+                _add(counter, 'value', value)
+        return results
+
+    def _api_perf_object_get_instances_iter_start(self, request):
+        self._perf_object(request)
+        names = list(enumerate(self.perf_instances))
+        wanted = request.child_get('instances')
+        if wanted is not None:
+            wanted = set([i.content for i in wanted.children])
+            names = [n for n in names if n[1] in wanted]
+        counters = request.child_get('counters')
+        if counters is not None:
+            counters = set([c.content for c in counters.children])
+
+        tag = self.next_tag
+        self.next_tag = self.next_tag + 1
+        self.iterators[tag] = (names, counters)
+
+        results = ZapiElement('results')
+        _add(results, 'records', str(len(names)))
+        _add(results, 'tag', str(tag))
+        return results
+
+    def _api_perf_object_list_info(self, request):
+        results = ZapiElement('results')
+        objects = _add(results, 'objects')
+        obj = _add(objects, 'object-info')
+        _add(obj, 'name', 'volume')
+        _add(obj, 'privilege-level', 'basic')
+        return results
+
+    def _api_snapshot_create(self, request):
+        snaps = self._volume(request)['snapshots']
+        snaps[request.child_get_string('snapshot')] = {
+            'access-time': int(time.time()), 'busy': False, 'total': 0}
+        return ZapiElement('results')
+
+    def _api_snapshot_delete(self, request):
+        snaps = self._volume(request)['snapshots']
+        name = request.child_get_string('snapshot')
+        if name not in snaps:
+            raise StubError(13009, 'No such snapshot %s' % name)
+        if snaps[name]['busy']:
+            raise StubError(13022, 'Snapshot %s is busy' % name)
+        del snaps[name]
+        return ZapiElement('results')
+
+    def _api_snapshot_rename(self, request):
+        snaps = self._volume(request)['snapshots']
+        name = request.child_get_string('current-name')
+        if name not in snaps:
+            raise StubError(13009, 'No such snapshot %s' % name)
+        snaps[request.child_get_string('new-name')] = snaps.pop(name)
+        return ZapiElement('results')
+
+    def _api_snapshot_get_reserve(self, request):
+        results = ZapiElement('results')
+        _add(results, 'percent-reserved',
+             str(self._volume(request)['snapshot-percent-reserved']))
+        return results
+
+    def _api_snapshot_get_schedule(self, request):
+        self._volume(request)
+        results = ZapiElement('results')
+        for field, value in (('days', '2'), ('hours', '6'), ('minutes', '0'),
+                             ('weeks', '0'), ('which-hours', '8,12,16,20'),
+                             ('which-minutes', '')):
+            _add(results, field, value)
+        return results
+
+    def _api_snapshot_list_info(self, request):
+        snaps = self._volume(request, 'target-name')['snapshots']
+        results = ZapiElement('results')
+        snapshots = _add(results, 'snapshots')
+        for name in sorted(snaps, key=lambda n: snaps[n]['access-time']):
+            info = _add(snapshots, 'snapshot-info')
+            _add(info, 'name', name)
+            _add(info, 'access-time', str(snaps[name]['access-time']))
+            _add(info, 'busy', str(snaps[name]['busy']).lower())
+            _add(info, 'total', str(snaps[name]['total']))
+            _add(info, 'cumulative-total', str(snaps[name]['total']))
+        return results
+
+    def _api_snmp_get(self, request):
+        full = [name for name in sorted(self.volumes)
+                if self.volumes[name]['used-percent'] >= 98]
+        if full:
+            message = ('/vol/%s is full (using or reserving 99%% of space '
+                       'and 0%% of inodes, using 99%% of reserve).' % full[0])
+        else:
+            message = 'All volumes have adequate space.'
+        results = ZapiElement('results')
+        _add(results, 'value', message)
+        return results
+
+    def _api_system_cli(self, request):
+        args = [arg.content for arg in request.child_get('args').children]
+        results = ZapiElement('results')
+        if args[:2] == ['cifs', 'shares'] and len(args) <= 3:
+            _add(results, 'cli-output', self._cifs_shares(args[2:]))
+        elif args[:3] == ['cifs', 'shares', '-add']:
+            self.shares[args[3]] = {'mount-point': args[4],
+                                    'description': '',
+                                    'options': [],
+                                    'access': {'everyone': 'Full Control'}}
+            _add(results, 'cli-output', '')
+        elif args[:2] == ['cifs', 'access'] and args[2] != '-delete':
+            self._share(args[2])['access'][args[3]] = args[4]
+            _add(results, 'cli-output', '')
+        elif args[:3] == ['cifs', 'access', '-delete']:
+            self._share(args[3])['access'].pop(args[4], None)
+            _add(results, 'cli-output', '')
+        else:
+            _add(results, 'cli-output',
+                 '%s not supported by stub\n' % ' '.join(args))
+        return results
+
+    def _api_system_get_version(self, request):
+        results = ZapiElement('results')
+        _add(results, 'version', self.version)
+        _add(results, 'is-clustered', 'false')
+        return results
+
+    def _api_volume_autosize_get(self, request):
+        vol = self._volume(request)
+        results = ZapiElement('results')
+        _add(results, 'is-enabled', str(vol['autosize-enabled']).lower())
+        _add(results, 'increment-size', str(vol['increment-size']))
+        _add(results, 'maximum-size', str(vol['maximum-size']))
+        return results
+
+    def _api_volume_list_info(self, request):
+        name = request.child_get_string('volume')
+        if name is not None:
+            names = [self._volume_name(name)]
+        else:
+            names = sorted(self.volumes)
+
+        results = ZapiElement('results')
+        volumes = _add(results, 'volumes')
+        for name in names:
+            vol = self.volumes[name]
+            total = vol['size-kb'] * 1024 * (
+                100 - vol['snapshot-percent-reserved']) / 100
+            used = total * vol['used-percent'] / 100
+            info = _add(volumes, 'volume-info')
+            _add(info, 'name', name)
+            _add(info, 'type', 'flex')
+            _add(info, 'state', 'online')
+            _add(info, 'containing-aggregate', vol['aggr'])
+            _add(info, 'size-total', str(total))
+            _add(info, 'size-used', str(used))
+            _add(info, 'size-available', str(total - used))
+            _add(info, 'percentage-used', str(vol['used-percent']))
+            _add(info, 'snapshot-percent-reserved',
+                 str(vol['snapshot-percent-reserved']))
+            _add(info, 'files-total', '1000000')
+            _add(info, 'files-used', str(vol['used-percent'] * 100))
+            _add(_add(info, 'plexes'), 'plex-info')
+        return results
+
+    def _api_volume_size(self, request):
+        vol = self._volume(request)
+        new_size = request.child_get_string('new-size')
+        if new_size is not None:
+            m = re.match(r'^([+-]?)(\d+)([kmgt]?)$', new_size)
+            if not m:
+                raise StubError(13115, 'Invalid size %s' % new_size)
+            kb = int(m.groups()[1]) * {'': 1, 'k': 1, 'm': 1024,
+                                       'g': 1024 ** 2,
+                                       't': 1024 ** 3}[m.groups()[2]]
+            old_kb = vol['size-kb']
+            if m.groups()[0] == '+':
+                vol['size-kb'] = old_kb + kb
+            elif m.groups()[0] == '-':
+                vol['size-kb'] = old_kb - kb
+            else:
+                vol['size-kb'] = kb
+            vol['used-percent'] = vol['used-percent'] * old_kb / vol['size-kb']
+
+        results = ZapiElement('results')
+        _add(results, 'volume-size', '%dg' % (vol['size-kb'] / 1024 / 1024))
+        return results
+
+    #
+    # Helpers
+    #
+
+    def _cifs_shares(self, names):
+        """Render 'cifs shares [name]' CLI output."""
+
+        lines = ['%-13s%-34s%s' % ('Name', 'Mount Point', 'Description'),
+                 '%-13s%-34s%s' % ('----', '-----------', '-----------')]
+        if names and names[0] not in self.shares:
+            return 'No share is matching that name.\n'
+        for name in names or sorted(self.shares):
+            share = self.shares[name]
+            lines.append('%-12s %-33s %s' % (name, share['mount-point'],
+                                             share['description']))
+            for option in share['options']:
+                lines.append('\t\t\t... %s' % option)
+            for user in sorted(share['access']):
+                lines.append('\t\t\t%s / %s' % (user, share['access'][user]))
+        return '\n'.join(lines) + '\n'
+
+    def _failed(self, errno, reason):
+        results = ZapiElement('results')
+        results.attr_set('status', 'failed')
+        results.attr_set('errno', str(errno))
+        results.attr_set('reason', reason)
+        return results
+
+    def _perf_object(self, request):
+        if request.child_get_string('objectname') != 'volume':
+            raise StubError(13001, 'Object %s not found' %
+                            request.child_get_string('objectname'))
+
+    def _read_rule(self, rule):
+        """Convert an 'exports-rule-info' request element to an export."""
+
+        export = {'nosuid': rule.child_get_string('nosuid') == 'true',
+                  'sec-flavor': 'sys'}
+        for hosts in ('read-only', 'read-write', 'root'):
+            host_list = rule.child_get(hosts)
+            if host_list is None:
+                export[hosts] = []
+            else:
+                export[hosts] = [h.child_get_string('name')
+                                 for h in host_list.children]
+        return export
+
+    def _share(self, name):
+        if name not in self.shares:
+            raise StubError(13001, 'No share is matching that name.')
+        return self.shares[name]
+
+    def _volume(self, request, field='volume'):
+        return self.volumes[self._volume_name(
+            request.child_get_string(field))]
+
+    def _volume_name(self, name):
+        name = re.sub(r'^/vol/', '', name or '')
+        if name not in self.volumes:
+            raise StubError(13040, 'No volume named %s exists' % name)
+        return name
+
+
+class StubError(Exception):
+    """A ZAPI failure to be reported by SyntheticFiler."""
+
+    def __init__(self, errno, reason):
+        self.errno = errno
+        self.reason = reason
+
+
+class StubTransport(KeepAliveTransport):
+    """
+    Send a Filer's requests to a SyntheticFiler in-process.
+
+    Requests and responses still travel as ZAPI XML, so encoding and
+    decoding costs are included when profiling; only the network is
+    bypassed.
+    """
+
+    def __init__(self, stub, fast_xml=False):
+        KeepAliveTransport.__init__(self, 'stub', '', '',
+                                    transport_type='HTTP', fast_xml=fast_xml)
+        self.stub = stub
+
+    def _post(self, request):
+        return (200, self.stub.handle(request))
+
+
+class ZapiStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serve a SyntheticFiler's ZAPI over HTTP at 'address'.
+
+    Connect with Ontap.KeepAliveTransport(host, user, passwd,
+    transport_type='HTTP', port=port); credentials are not checked.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stub, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ZapiStubHandler)
+        self.stub = stub
+        self.thread = None
+
+    def start(self):
+        """Serve requests from a background thread."""
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving and close the listening socket."""
+
+        self.shutdown()
+        self.server_close()
+
+
+class ZapiStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP request handler for ZapiStubServer."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.path != KeepAliveTransport.url:
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        response = self.server.stub.handle(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _add(parent, name, content=''):
+    """Append a new child element to parent and return it."""
+
+    child = ZapiElement(name, content)
+    parent.child_add(child)
+    return child
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve a synthetic filer over ZAPI.')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--volumes', type=int, default=10)
+    parser.add_argument('--exports', type=int, default=10)
+    parser.add_argument('--shares', type=int, default=10)
+    parser.add_argument('--perf-instances', type=int, default=10)
+    parser.add_argument('--snapshots', type=int, default=10)
+    parser.add_argument('--aggrs', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to delay each response')
+    args = parser.parse_args()
+
+    stub = SyntheticFiler(volumes=args.volumes, exports=args.exports,
+                          shares=args.shares,
+                          perf_instances=args.perf_instances,
+                          snapshots=args.snapshots, aggrs=args.aggrs,
+                          latency=args.latency)
+    server = ZapiStubServer(stub, (args.address, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,6 +1,6 @@
 #!/opt/virtualenv/admintools/bin/python
 
-import re
+import argparse
 import sys
 import yaml
 
@@ -9,76 +9,64 @@ sys.path.append('/opt/netapp-manageability-sdk-4.1/lib/python/NetApp')
 import Ontap
 
 
-def size_in_kb(string_size):
-    """Convert string_size with optional (k,m,g,t) suffix to gigabytes."""
+def reason(e):
+    """Return a printable description of exception e."""
 
-    # Remove last character from string:
-    suffix = string_size[-1]
-    value = int(string_size[:-1])
+    if isinstance(e, Ontap.OntapApiException):
+        return e.reason
+    return str(e)
 
-    if suffix == 't':
-        scale_factor = 1024 * 1024 * 1024
-    elif suffix == 'g':
-        scale_factor = 1024 * 1024
-    elif suffix == 'm':
-        scale_factor = 1024
-    elif suffix == 'k':
-        scale_factor = 1
-
-    return value * scale_factor
 
 if __name__ == '__main__':
     """
-    If Filer is warning/critical on FlexVol space, attempt to remediate.
+    Grow every FlexVol nearing full on each filer, within its autosize
+    limits.
 
     Autosize rules and increments are used, if they exist.  This can be
     thought of as a more-aggressively triggered autosize operation.
 
-    Required NetApp role permissions: login-http-admin, api-snmp-get,
-    api-snapshot-get-reserve, api-system-get-version,
-    api-volume-autosize-get, api-volume-size
+    Required NetApp role permissions: login-http-admin,
+    api-system-get-version, api-volume-autosize-get, api-volume-list-info,
+    api-volume-size
     """
 
+    parser = argparse.ArgumentParser(
+        description='Grow nearly full volumes within autosize limits.')
+    parser.add_argument('-t', '--threshold', type=int, default=95,
+                        help='Percentage used at which a volume is grown')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Print the volumes to grow without growing them')
+    args = parser.parse_args()
+
     # Gather authentication info
     f = open('/opt/ops-scripts/etc/netapp-space-check.yaml')
     auth = yaml.load(f.read())
     f.close()
 
-    # Connect to NetApp filers:
-    filers = []
-    for filer in auth['filers']:
-        filers.append(Ontap.Filer(filer['hostname'],
-                                  filer['user'],
-                                  filer['passwd']))
-
-    for filer in filers:
-        try:
-            message = filer.get_fs_status_msg().rstrip()
-        except Ontap.OntapApiException as e:
-            print "Failed with error: %s: %s" % (filer.name, e.reason)
-            raise
-
-        if message == 'All volumes have adequate space.':
-            continue
-
-        print message
-
-        vol_path = re.match(r'^/vol/(\S+)\s', message).groups()[0]
-
-        try:
-            v = filer.get_volume(vol_path)
-            v_size = size_in_kb(v.get_size())
-            as_incr = v.get_autosize_increment()
-            as_max = v.get_autosize_max_size()
-
-            if v_size < as_max:
-                if v_size + as_incr > as_max:
-                    print "Resize /vol/%s to %iKB" % (v.name, as_max)
-                    v.set_size(str(as_max))
-                else:
-                    print "Grow /vol/%s by %iKB to %iKB" % (v.name, as_incr,
-                                                            v_size + as_incr)
-                    v.set_size("+%ik" % as_incr)
-        except Ontap.OntapApiException as e:
-            print "Failed with error: %s: %s" % (v.filer.name, e.reason)
-            continue
+    # Connect to NetApp filers in parallel:
+    pool = Ontap.FilerPool()
+    for hostname, e in pool.connect(auth['filers']).items():
+        print "Failed to connect: %s" % hostname
+        raise e
+
+    remediator = Ontap.AutosizeRemediator(pool, threshold=args.threshold)
+    plan = remediator.remediate(dry_run=args.dry_run)
+
+    for name, e in sorted(remediator.errors.items()):
+        print "Failed with error: %s: %s" % (name, reason(e))
+
+    for entry in plan:
+        vol = "%s:/vol/%s (%d%% used, %iKB)" % (
+            entry['filer'], entry['volume'], entry['percentage-used'],
+            entry['size'])
+        if entry['result'] == 'at-maximum':
+            print "%s is at its autosize maximum" % vol
+        elif entry['result'] == 'failed':
+            print "Failed with error: %s: %s" % (vol, reason(entry['error']))
+        elif entry['new-size'].startswith('+'):
+            print "Grow %s by %s" % (vol, entry['new-size'][1:])
+        else:
+            print "Resize %s to %sKB" % (vol, entry['new-size'])
+
+    if remediator.errors:
+        sys.exit(1)
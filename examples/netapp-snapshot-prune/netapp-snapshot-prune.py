@@ -0,0 +1,89 @@
+#!/opt/virtualenv/admintools/bin/python
+
+import argparse
+import sys
+import time
+import yaml
+
+# Load NetApp API wrapper:
+sys.path.append('/opt/netapp-manageability-sdk-4.1/lib/python/NetApp')
+import Ontap
+
+
+def reason(e):
+    """Return a printable description of exception e."""
+
+    if isinstance(e, Ontap.OntapApiException):
+        return e.reason
+    return str(e)
+
+
+if __name__ == '__main__':
+    """
+    Delete snapshots that have expired under the configured rules.
+
+    The configuration file lists filers (as for netapp-force-autosize)
+    and rules, each with a snapshot name 'pattern' and optionally
+    'keep_last', 'max_age_days' and a 'volumes' pattern.  The first
+    rule matching a snapshot governs it.  With --dry-run, the deletion
+    plan is printed and nothing is deleted.
+
+    Required NetApp role permissions: login-http-admin,
+    api-snapshot-delete, api-snapshot-list-info, api-system-get-version,
+    api-volume-list-info
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Prune expired snapshots across NetApp filers.')
+    parser.add_argument('-c', '--config',
+                        default='/opt/ops-scripts/etc/'
+                                'netapp-snapshot-prune.yaml',
+                        help='YAML file of filers and retention rules')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Print the deletion plan without deleting')
+    parser.add_argument('-p', '--per-filer-limit', type=int, default=4,
+                        help='Maximum deletes in flight per filer')
+    args = parser.parse_args()
+
+    f = open(args.config)
+    config = yaml.safe_load(f.read())
+    f.close()
+
+    rules = []
+    for rule in config['rules']:
+        max_age = rule.get('max_age_days')
+        if max_age is not None:
+            max_age = max_age * 86400
+        rules.append(Ontap.RetentionRule(rule['pattern'],
+                                         keep_last=rule.get('keep_last'),
+                                         max_age=max_age,
+                                         volumes=rule.get('volumes')))
+
+    pool = Ontap.FilerPool(per_filer_limit=args.per_filer_limit)
+    for hostname, e in pool.connect(config['filers']).items():
+        print "Failed to connect: %s: %s" % (hostname, reason(e))
+
+    pruner = Ontap.SnapshotPruner(pool, rules)
+    plan = pruner.prune(dry_run=args.dry_run)
+
+    for name, e in sorted(pruner.errors.items()):
+        print "Failed to list snapshots: %s: %s" % (name, reason(e))
+
+    for (name, volume), e in sorted(pruner.volume_errors.items()):
+        print "Failed to list snapshots: %s:/vol/%s: %s" % (name, volume,
+                                                            reason(e))
+
+    failed = False
+    for entry in plan:
+        line = "%-8s %s:/vol/%s@%s (%s)" % (
+            entry['result'], entry['filer'], entry['volume'],
+            entry['snapshot'],
+            time.strftime('%Y-%m-%d %H:%M',
+                          time.localtime(entry['access-time'])))
+        if entry['error']:
+            line = line + ": " + reason(entry['error'])
+            failed = True
+        print line
+
+    if failed or pruner.errors or pruner.volume_errors:
+        sys.exit(1)
@@ -0,0 +1,178 @@
+#!/opt/virtualenv/admintools/bin/python
+
+import argparse
+import sys
+import time
+import yaml
+
+# Load NetApp API wrapper:
+sys.path.append('/opt/netapp-manageability-sdk-4.1/lib/python/NetApp')
+import Ontap
+import OntapStub
+
+
+class CountingTransport(OntapStub.StubTransport):
+    """A StubTransport that tallies request and response bytes."""
+
+    def __init__(self, stub):
+        OntapStub.StubTransport.__init__(self, stub)
+        self.bytes = 0
+
+    def _post(self, request):
+        status, body = OntapStub.StubTransport._post(self, request)
+        self.bytes = self.bytes + len(request) + len(body)
+        return (status, body)
+
+
+def aggr_space(filer):
+    """Report space for every aggregate."""
+
+    for a in filer.get_aggrs():
+        a.get_space()
+
+
+def export_audit(filer):
+    """Read every setting of every NFS export."""
+
+    for e in filer.get_exports():
+        e.get_ro_hosts()
+        e.get_rw_hosts()
+        e.get_root_hosts()
+        e.get_nosuid()
+        e.get_sec_flavor()
+
+
+def fleet_autosize(filer):
+    """Grow every nearly full volume with AutosizeRemediator."""
+
+    Ontap.AutosizeRemediator(Ontap.FilerPool([filer])).remediate()
+
+
+def force_autosize(filer):
+    """Follow netapp-force-autosize's path for a nearly full volume."""
+
+    message = filer.get_fs_status_msg().rstrip()
+    if message == 'All volumes have adequate space.':
+        return
+
+    v = filer.get_volume(message.split()[0])
+    v_size = size_in_kb(v.get_size())
+    autosize = v.get_autosize()
+    as_incr = autosize['increment-size']
+    as_max = autosize['maximum-size']
+
+    if v_size < as_max:
+        if v_size + as_incr > as_max:
+            v.set_size(str(as_max))
+        else:
+            v.set_size("+%ik" % as_incr)
+
+
+def perf_volume(filer):
+    """Read all counters of all instances of the 'volume' perf object."""
+
+    filer.get_perf_object('volume')
+
+
+def size_in_kb(string_size):
+    """Convert string_size with (k,m,g,t) suffix to kilobytes."""
+
+    scale = {'k': 1, 'm': 1024, 'g': 1024 ** 2, 't': 1024 ** 3}
+    return int(string_size[:-1]) * scale[string_size[-1]]
+
+
+def share_audit(filer):
+    """Read every setting of every CIFS share."""
+
+    for s in filer.get_shares():
+        s.get_description()
+        s.get_mount_point()
+        s.get_access()
+        s.get_umask()
+        s.get_dir_umask()
+        s.get_file_umask()
+        s.get_forcegroup()
+
+
+def volume_df(filer):
+    """Report space for every volume."""
+
+    for v in filer.get_volumes():
+        v.get_df()
+
+
+def run_workflow(func, dataset):
+    """Run func against a fresh synthetic filer; return its costs."""
+
+    stub = OntapStub.SyntheticFiler(**dataset)
+    transport = CountingTransport(stub)
+    filer = Ontap.Filer('stub', 'user', 'passwd', transport=transport)
+
+    start = time.time()
+    func(filer)
+    elapsed = time.time() - start
+
+    return {'calls': sum(stub.calls.values()),
+            'calls-by-api': stub.calls,
+            'bytes': transport.bytes,
+            'seconds': elapsed}
+
+
+WORKFLOWS = {'aggr-space': aggr_space,
+             'export-audit': export_audit,
+             'fleet-autosize': fleet_autosize,
+             'force-autosize': force_autosize,
+             'perf-volume': perf_volume,
+             'share-audit': share_audit,
+             'volume-df': volume_df}
+
+if __name__ == '__main__':
+    """
+    Measure the API calls, bytes and time spent by common workflows.
+
+    Each workflow is run against an in-process synthetic filer
+    (OntapStub) sized by the baseline file.  The run fails if any
+    workflow makes more API calls than its recorded baseline.
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark Ontap.py workflows against a stub filer.')
+    parser.add_argument('-b', '--baseline',
+                        default='ontap-benchmark-baseline.yaml',
+                        help='YAML file of data set size and call counts')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='Record current call counts as the baseline')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show call counts per API')
+    args = parser.parse_args()
+
+    f = open(args.baseline)
+    baseline = yaml.safe_load(f.read())
+    f.close()
+
+    failed = False
+    for name in sorted(WORKFLOWS):
+        cost = run_workflow(WORKFLOWS[name], baseline['dataset'])
+        limit = baseline['calls'].get(name)
+
+        if limit is not None and cost['calls'] > limit:
+            status = 'REGRESSED (baseline %d calls)' % limit
+            failed = True
+        else:
+            status = 'ok'
+
+        print "%-16s %6d calls %10d bytes %8.3fs  %s" % (
+            name, cost['calls'], cost['bytes'], cost['seconds'], status)
+        if args.verbose:
+            for api in sorted(cost['calls-by-api']):
+                print "    %-44s %6d" % (api, cost['calls-by-api'][api])
+
+        if args.update:
+            baseline['calls'][name] = cost['calls']
+
+    if args.update:
+        f = open(args.baseline, 'w')
+        f.write(yaml.safe_dump(baseline, default_flow_style=False))
+        f.close()
+    elif failed:
+        sys.exit(1)